@@ -1,16 +1,24 @@
-from numpy import cross, append, sign, inner, mean, pi, arctan2, sqrt
+from numpy import asarray, cross, append, sign, inner, mean, pi, arctan2, sqrt, array, ascontiguousarray, column_stack, dtype, sort, unique, void
 from numpy.linalg import norm
 
 from datastructures import MultiValueDict
 
 class GeometricObject(object):
+    __slots__ = ()
     intersection_tolerance = 0.00001
     def __init__(self):
         pass
 
 class Plane(GeometricObject):
+    """A plane given by the params (a, b, c, d). The normal and d are split
+    off once on construction.
+    """
+    __slots__ = ('params', 'normal', 'd')
+    
     def __init__(self, params):
-        self.params = params
+        self.params = asarray(params, dtype=float)
+        self.normal = self.params[0:3]
+        self.d = float(self.params[3])
     
     def _get_a(self):
         return self.params[0]
@@ -24,14 +32,6 @@ class Plane(GeometricObject):
         return self.params[2]
     c = property(_get_c)
     
-    def _get_d(self):
-        return self.params[3]
-    d = property(_get_d)
-    
-    def _get_normal(self):
-        return self.params[0:3]
-    normal = property(_get_normal)
-    
     def get_signed_distance(self, point):
         return (inner(self.normal, point) + self.d)# / norm(self.normal)
     
@@ -52,6 +52,8 @@ class Plane(GeometricObject):
         return str(self.params)
 
 class Polygon(GeometricObject):
+    __slots__ = ('vertices', )
+    
     def __init__(self, vertices):
         GeometricObject.__init__(self)
         self.vertices = vertices
@@ -74,16 +76,26 @@ class Polygon(GeometricObject):
         return True
 
 class Triangle(Polygon):
+    """A triangle, whose vertices are stored as one (3, 3) array. The edges
+    from the first corner, the normal and the plane offset are computed once
+    on construction. The plane of the triangle holds all points p with
+    inner(normal, p) == plane_offset.
+    """
+    __slots__ = ('edges', 'normal', 'plane_offset')
+    
     def __init__(self, vertices):
-        Polygon.__init__(self, vertices)
+        Polygon.__init__(self, asarray(vertices, dtype=float))
+        self.edges = self.vertices[1:3] - self.vertices[0]
         self.normal = self._computeNormal()
+        self.plane_offset = inner(self.normal, self.vertices[0])
     
     def _computeNormal(self):
-        normal = -1 * cross(self.vertices[0] - self.vertices[1], self.vertices[0] - self.vertices[2])
+        normal = -cross(self.edges[0], self.edges[1])
         return normal / norm(normal)
     
     def get_plane(self):
-        return Plane(append(self.normal, [-inner(self.normal, self.vertices[0]), ]))
+        # the signed distance of the plane is inner(normal, p) + d
+        return Plane(append(self.normal, [-self.plane_offset, ]))
     
     def get_plane_intersections(self, plane):
         intersections = []
@@ -115,6 +127,8 @@ class Triangle(Polygon):
         return "Vertices: %s, Normal: %s" % (str(self.vertices), str(self.normal))
 
 class Quad(Polygon):
+    __slots__ = ()
+    
     def __init__(self, vertices):
         Polygon.__init__(self, vertices)
     
@@ -123,7 +137,40 @@ class Quad(Polygon):
         triangle2 = Triangle(self.vertices[2:4] + self.vertices[0:1])
         return [triangle1, triangle2]
 
+def _changes_geometry(method):
+    """Wraps a mutating list method of TriangleList, so that it drops the
+    cached geometry after the call.
+    """
+    def changing(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self.geometry_changed()
+        return result
+    changing.__name__ = method.__name__
+    changing.__doc__ = method.__doc__
+    return changing
+
 class TriangleList(list):
+    """A list of triangles. The texture maps are cached; the mutating list
+    methods drop the cache, changing the vertices of a contained triangle
+    needs a call to geometry_changed.
+    """
+    projections = ('sphere', 'cylinder', 'plane')
+    _texture_maps = None
+    
+    append = _changes_geometry(list.append)
+    extend = _changes_geometry(list.extend)
+    insert = _changes_geometry(list.insert)
+    remove = _changes_geometry(list.remove)
+    pop = _changes_geometry(list.pop)
+    sort = _changes_geometry(list.sort)
+    reverse = _changes_geometry(list.reverse)
+    __setitem__ = _changes_geometry(list.__setitem__)
+    __delitem__ = _changes_geometry(list.__delitem__)
+    __setslice__ = _changes_geometry(list.__setslice__)
+    __delslice__ = _changes_geometry(list.__delslice__)
+    __iadd__ = _changes_geometry(list.__iadd__)
+    __imul__ = _changes_geometry(list.__imul__)
+    
     def get_vertex_map(self):
         result = MultiValueDict()
         for triangle in self:
@@ -140,10 +187,74 @@ class TriangleList(list):
         return normal_map
     
     def get_vertex_sphere_map(self):
-        vertex_map = self.get_vertex_map()
-        texture_map = {}
-        for vertex in vertex_map.keys():
-            u = (pi + arctan2(vertex[1], vertex[0])) / (2 * pi)
-            v = arctan2(sqrt(vertex[0]**2 + vertex[1]**2), vertex[2]) / pi
-            texture_map[tuple(vertex)] = (u, v)
-        return texture_map
+        return self.get_vertex_texture_map('sphere')
+    
+    def get_vertex_texture_map(self, projection='sphere'):
+        """Returns a dictionary mapping every vertex tuple to its (u, v)
+        texture coordinates. The coordinates of all distinct vertices are
+        computed in one pass (see get_texture_coordinates). The map is cached
+        per projection until geometry_changed is called.
+        
+        :Parameters:
+            projection : string
+                one of `projections`
+        """
+        if self._texture_maps is None:
+            self._texture_maps = {}
+        if projection not in self._texture_maps:
+            if len(self):
+                vertices = unique_rows(array([triangle.vertices for triangle in self], dtype=float).reshape((-1, 3)))
+            else:
+                vertices = array([]).reshape((0, 3))
+            coordinates = get_texture_coordinates(vertices, projection)
+            self._texture_maps[projection] = dict(zip([tuple(vertex) for vertex in vertices.tolist()],
+                                                      [tuple(uv) for uv in coordinates.tolist()]))
+        return self._texture_maps[projection]
+    
+    def geometry_changed(self):
+        """Drops the cached texture maps. Call this after changing the
+        vertices of a contained triangle in place.
+        """
+        self._texture_maps = None
+
+def get_texture_coordinates(vertices, projection='sphere'):
+    """Returns a (V, 2) array holding the texture coordinates of the (V, 3)
+    vertices.
+    
+    :Parameters:
+        vertices : array
+            the vertices to map
+        projection : string
+            'sphere' maps longitude and colatitude around the z axis,
+            'cylinder' maps longitude and height along the z axis and
+            'plane' maps x and y; heights and plane coordinates are scaled
+            to the extent of the vertices
+    """
+    x, y, z = vertices[:, 0], vertices[:, 1], vertices[:, 2]
+    if projection == 'sphere':
+        u = (pi + arctan2(y, x)) / (2 * pi)
+        v = arctan2(sqrt(x**2 + y**2), z) / pi
+    elif projection == 'cylinder':
+        u = (pi + arctan2(y, x)) / (2 * pi)
+        v = _scale_to_unit(z)
+    elif projection == 'plane':
+        u = _scale_to_unit(x)
+        v = _scale_to_unit(y)
+    else:
+        raise ValueError(u"unknown texture projection '%s'" % projection)
+    return column_stack((u, v))
+
+def _scale_to_unit(values):
+    if not len(values) or values.max() == values.min():
+        return values * 0.0
+    return (values - values.min()) / (values.max() - values.min())
+
+def unique_rows(rows):
+    """Returns the distinct rows of a 2d array."""
+    if not len(rows):
+        return rows
+    # adding 0.0 turns -0.0 into 0.0, so both compare equal byte-wise
+    rows = ascontiguousarray(rows) + 0.0
+    row_view = rows.view(dtype((void, rows.dtype.itemsize * rows.shape[1]))).ravel()
+    unused, indices = unique(row_view, return_index=True)
+    return rows[sort(indices)]
@@ -213,7 +213,7 @@ class MeshScene(Scene):
         Scene.init(self)
         
         # get triangle bsp tree
-        triangles = openOff("./meshes/teapot.off").get_triangles()
+        triangles = openOff("./meshes/teapot.off", workers=self.application._config.getint('reader', 'workers')).get_triangles()
         self._log.debug(u"Constructing bsp tree...")
         bsptree = TriangleBspTree(triangles,
                                   scene=self, 
@@ -379,7 +379,7 @@ class TexturedObjectScene(WindowedScene):
         self.tex = Texture(image = self.application._current_texture)
         # get triangle mesh
         self._log.debug(u"Loading mesh...")
-        triangles = openOff("./data/cow.off").get_triangles()
+        triangles = openOff("./data/cow.off", workers=self.application._config.getint('reader', 'workers')).get_triangles()
         mesh = TriangleMeshNode(triangles   = triangles,
                                 scene       = self, 
                                 #scaling=[0.5, 0.5, 0.5],
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+This is a benchmark for the mesh readers. It loads every OFF file of the
+bundled mesh directories with each loader mode and writes the parse time, the
+peak memory and the triangle throughput to a JSON file, so results of
+different commits can be compared. The triangles mode builds a TriangleList of
+Triangle objects from the cached arrays, so its memory per triangle is that of
+the geometry classes.
+
+The comments in this file are written in the reStructured text format and adhere
+to the commenting style used by epydoc.
+"""
+
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import time
+from glob import glob
+from multiprocessing import Process, Queue
+from optparse import OptionParser
+
+import numpy
+
+from reader import openOff
+
+base_directory = os.path.dirname(os.path.abspath(__file__))
+mesh_directories = [os.path.join(base_directory, 'meshes'),
+                    os.path.join(base_directory, '..', 'cg1_ex4', 'data')]
+
+def load_text(filename, workers):
+    vertices, faces = openOff(filename, cache=False).get_arrays()
+    return len(faces)
+
+def load_cached(filename, workers):
+    vertices, faces = openOff(filename).get_arrays()
+    return len(faces)
+
+def load_parallel(filename, workers):
+    mesh_reader = openOff(filename, cache=False, workers=workers)
+    mesh_reader.parallel_threshold = 0
+    vertices, faces = mesh_reader.get_arrays()
+    return len(faces)
+
+def load_stream(filename, workers):
+    triangle_count = 0
+    for indices, corners in openOff(filename, cache=False).iter_faces():
+        triangle_count += len(indices)
+    return triangle_count
+
+def load_triangles(filename, workers):
+    triangles = openOff(filename).get_triangles()
+    return len(triangles)
+
+modes = {
+    'text'      : load_text,
+    'cached'    : load_cached,
+    'parallel'  : load_parallel,
+    'stream'    : load_stream,
+    'triangles' : load_triangles,
+    }
+
+def _measure(queue, mode, filename, workers):
+    """Loads the file once and reports the time and the growth of the peak
+    resident memory. This runs in a fresh process, so the peak memory of
+    earlier runs does not hide that of this one.
+    """
+    try:
+        peak_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        triangle_count = modes[mode](filename, workers)
+        duration = time.time() - start
+        peak_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        queue.put((duration, (peak_after - peak_before) * 1024, triangle_count, None))
+    except Exception, e:
+        queue.put((None, None, None, str(e)))
+
+def measure(mode, filename, workers):
+    queue = Queue()
+    process = Process(target=_measure, args=(queue, mode, filename, workers))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+def get_revision():
+    try:
+        return subprocess.Popen(['git', 'rev-parse', 'HEAD'], cwd=base_directory, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[0].strip() or None
+    except OSError:
+        return None
+
+def run(filenames, mode_names, repeat, workers):
+    results = []
+    for filename in filenames:
+        if 'cached' in mode_names or 'triangles' in mode_names:
+            # build the cache, so only loading from it is measured
+            openOff(filename).get_arrays()
+        for mode in mode_names:
+            durations = []
+            peak_memory = 0
+            for iteration in range(repeat):
+                duration, memory, triangle_count, error = measure(mode, filename, workers)
+                if error:
+                    break
+                durations.append(duration)
+                peak_memory = max(peak_memory, memory)
+            result = {
+                'file'          : os.path.relpath(filename, os.path.join(base_directory, '..')),
+                'size'          : os.path.getsize(filename),
+                'mode'          : mode,
+                }
+            if error:
+                result['error'] = error
+            else:
+                best = min(durations)
+                result.update({
+                    'triangles'             : triangle_count,
+                    'parse_time'            : best,
+                    'parse_times'           : durations,
+                    'peak_memory'           : peak_memory,
+                    'bytes_per_triangle'    : triangle_count and peak_memory / triangle_count,
+                    'triangles_per_second'  : best and triangle_count / best,
+                    })
+            logging.info(u"%-30s %-10s %s" % (result['file'], mode, error or u"%.4f s, %d bytes" % (result['parse_time'], peak_memory)))
+            results.append(result)
+    return results
+
+def main():
+    parser = OptionParser(usage=u"%prog [options] [mesh files]")
+    parser.add_option('-o', '--output', dest='output', default='benchmark.json', help=u"file to write the JSON results to")
+    parser.add_option('-m', '--modes', dest='modes', default=','.join(sorted(modes)), help=u"comma separated loader modes (%s)" % ', '.join(sorted(modes)))
+    parser.add_option('-r', '--repeat', dest='repeat', type='int', default=3, help=u"number of runs per file and mode; the fastest one is reported")
+    parser.add_option('-w', '--workers', dest='workers', type='int', default=4, help=u"number of processes of the parallel mode")
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    mode_names = [mode.strip() for mode in options.modes.split(',') if mode.strip()]
+    for mode in mode_names:
+        if mode not in modes:
+            parser.error(u"unknown mode '%s'" % mode)
+    if options.repeat < 1:
+        parser.error(u"the number of runs must be at least 1")
+    filenames = args or sorted(sum([glob(os.path.join(directory, '*.off')) for directory in mesh_directories], []))
+
+    results = run(filenames, mode_names, options.repeat, options.workers)
+    with open(options.output, 'w') as f:
+        json.dump({
+            'revision'  : get_revision(),
+            'date'      : time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python'    : platform.python_version(),
+            'numpy'     : numpy.__version__,
+            'platform'  : platform.platform(),
+            'results'   : results,
+            }, f, indent=2, sort_keys=True)
+    logging.info(u"Wrote results to '%s'." % options.output)
+
+if __name__ == '__main__':
+    main()
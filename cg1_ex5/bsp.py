@@ -1,25 +1,72 @@
+import logging
+import time
+from math import log
 from random import choice
 
-from numpy import inner
+from numpy import arange, argmin, array, asarray, einsum, empty, flatnonzero, inf, inner, linspace, unique, zeros
 from OpenGL.GL import *
 from OpenGL.GLUT import *
 
+from geometry import GeometricObject, TriangleAccelerator, TriangleArray, get_ray_triangle_hit
 from scenegraph import Node
 
 class BspTree(Node):
+    # a tree deeper than this factor times the depth of a balanced tree has
+    # degenerated into a chain of nodes
+    chain_depth_factor = 10
+    
     def __init__(self, node_objects, *args, **kwargs):
         Node.__init__(self, *args, **kwargs)
         self.node_objects = node_objects
         self.left_child   = None
         self.right_child  = None
     
-    def autopartition(self):
-        #print("depth: %d" % depth)
-        self.partition(self._get_autopartition_plane)
-        if self.left_child:
-            self.left_child.autopartition()
-        if self.right_child:
-            self.right_child.autopartition()
+    def autopartition(self, progress=None):
+        """Partitions the tree and logs the depth, node count and build time
+        of the result. The nodes are partitioned from an explicit stack, so
+        the depth of the tree is not limited by the recursion limit.
+        
+        :Keywords:
+          progress : callable
+            called as progress(done, total) after each partitioned node with
+            the number of objects placed in nodes so far and the number of
+            all objects
+        """
+        start = time.time()
+        total = len(self.node_objects)
+        done = 0
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            node.partition(node._get_autopartition_plane)
+            done += len(node.node_objects)
+            if progress is not None:
+                progress(done, total)
+            # the left subtree is partitioned first
+            for child in (node.right_child, node.left_child):
+                if child is not None:
+                    stack.append(child)
+        self.build_time = time.time() - start
+        depth, node_count = self.get_statistics()
+        logging.getLogger('BspTree').info(u"Built a BSP tree with %d nodes and depth %d in %.2f s." % (node_count, depth, self.build_time))
+        if node_count > 1 and depth > self.chain_depth_factor * log(node_count, 2):
+            logging.getLogger('BspTree').warning(u"The BSP tree has degenerated into a chain (depth %d of %d nodes), "
+                                                 u"drawing and tracing it will be slow." % (depth, node_count))
+    
+    def get_statistics(self):
+        """Returns a (depth, node count) tuple of the subtree, where the depth
+        is the number of nodes on the longest path from this node to a leaf.
+        """
+        depth, node_count = 0, 0
+        stack = [(self, 1)]
+        while stack:
+            node, node_depth = stack.pop()
+            depth = max(depth, node_depth)
+            node_count += 1
+            for child in (node.left_child, node.right_child):
+                if child is not None:
+                    stack.append((child, node_depth + 1))
+        return (depth, node_count)
     
     def draw(self, occluded=False):
         """
@@ -29,63 +76,179 @@ class BspTree(Node):
         """
         Node.draw(self)
 
-class TriangleBspTree(BspTree):
+class TriangleBspTree(BspTree, TriangleAccelerator):
+    """A BSP tree over triangles. Besides drawing them in painter's order, a
+    partitioned tree answers the ray queries of TriangleAccelerator by
+    walking the tree front to back, so it can be traced by the Raytracer.
+    The triangles of the queries are numbered in pre-order: the node objects
+    first, then the left and then the right subtree.
+    """
+    plane_selections = ('first', 'random', 'least_splits')
+    plane_selection = 'least_splits'
+    # the number of candidate planes scored per node
+    candidate_count = 16
+    split_weight = 0.5
+    
+    def __init__(self, node_objects, *args, **kwargs):
+        BspTree.__init__(self, node_objects, *args, **kwargs)
+        # the largest signed distance of the left subtree and the smallest of
+        # the right subtree from the partition plane; triangles are not split,
+        # so they may reach across the plane
+        self.left_extent  = inf
+        self.right_extent = -inf
+        # the TriangleArray of all triangles in the subtree, set up by the
+        # first ray query
+        self._triangles   = None
+        self._ray_data    = None
+        self._subtree_size = None
+        # the (N, 3, 3) corners of all triangles of the root and the indices
+        # of the node objects into them, set up by the first partition
+        self._corners     = None
+        self._indices     = None
+    
+    def _get_triangles(self):
+        if self._triangles is None:
+            self._prepare_rays()
+        return self._triangles
+    triangles = property(_get_triangles)
+    
+    def autopartition(self, plane_selection=None, candidate_count=None, split_weight=None, progress=None):
+        """Partitions the tree by planes of its own triangles.
+        
+        :Keywords:
+          plane_selection : string
+            how the plane of a node is chosen, one of `plane_selections`:
+            the plane of the first triangle, of a random one or of the
+            candidate with the least splits
+          candidate_count : int
+            the number of triangles, whose planes are scored per node by
+            'least_splits'
+          split_weight : float
+            the weight of the straddling triangles in the score of a plane,
+            the difference of the triangles on both sides gets the rest
+          progress : callable
+            called as progress(done, total) like in BspTree.autopartition
+        """
+        if plane_selection is not None:
+            self.plane_selection = plane_selection
+        if candidate_count is not None:
+            self.candidate_count = candidate_count
+        if split_weight is not None:
+            self.split_weight = split_weight
+        if self.plane_selection not in self.plane_selections:
+            raise ValueError(u"unknown plane selection '%s'" % self.plane_selection)
+        BspTree.autopartition(self, progress)
     
     def _get_autopartition_plane(self):
-        #partitioning_triangle = choice(self.node_objects)
-        partitioning_triangle = self.node_objects[0]
+        if self.plane_selection == 'least_splits' and len(self.node_objects) > 1:
+            return self._get_least_splits_plane()
+        elif self.plane_selection == 'random':
+            partitioning_triangle = choice(self.node_objects)
+        else:
+            partitioning_triangle = self.node_objects[0]
         return partitioning_triangle.get_plane()
     
+    def _get_node_corners(self):
+        """Returns the (N, 3, 3) corners of the node objects. They are indexed
+        from the corner array of the root, which is built once from the
+        triangles, so the nodes never collect them from the objects again.
+        """
+        if self._indices is None:
+            self._corners = array([geom_object.vertices for geom_object in self.node_objects], dtype=float).reshape((-1, 3, 3))
+            self._indices = arange(len(self.node_objects))
+        return self._corners[self._indices]
+    
+    def _get_least_splits_plane(self):
+        """Returns the plane of the candidate triangle, that straddles the
+        fewest triangles and splits the others most evenly. All candidates
+        are scored at once on the (candidates, triangles, corners) array of
+        signed distances.
+        """
+        node_objects = self.node_objects
+        if len(node_objects) <= self.candidate_count:
+            candidates = arange(len(node_objects))
+        else:
+            candidates = unique(linspace(0, len(node_objects) - 1, self.candidate_count).round().astype(int))
+        planes = [node_objects[candidate].get_plane() for candidate in candidates]
+        normals = array([plane.normal for plane in planes])
+        offsets = array([plane.d for plane in planes])
+        distances = einsum('cj,nkj->cnk', normals, self._get_node_corners()) + offsets[:, None, None]
+        
+        # classify the triangles like partition does
+        coplanar = (abs(distances) <= GeometricObject.intersection_tolerance).all(2)
+        straddling = (distances > 0).any(2) & (distances < 0).any(2) & ~coplanar
+        right = (distances[:, :, 0] > 0) & ~coplanar
+        left = ~right & ~coplanar
+        scores = self.split_weight * straddling.sum(1) + (1.0 - self.split_weight) * abs(left.sum(1) - right.sum(1))
+        return planes[argmin(scores)]
+    
+    def _create_child(self, indices):
+        """Returns a new subtree over the node objects at the given indices
+        into the corner array, that partitions like this one.
+        """
+        node_objects = self.node_objects
+        child = self.__class__([node_objects[index] for index in indices.tolist()], scene=self.scene)
+        child.plane_selection = self.plane_selection
+        child.candidate_count = self.candidate_count
+        child.split_weight = self.split_weight
+        child._corners = self._corners
+        child._indices = self._indices[indices]
+        return child
+    
     def partition(self, partition_plane_factory):
+        """Keeps the node objects in the partition plane and moves the others
+        into the left and right subtree. Triangles are not split: one, that
+        straddles the plane, goes to the side of its first vertex. All node
+        objects are classified at once on the corner array.
+        """
         self.partition_plane = partition_plane = partition_plane_factory()
-        keep        = []
-        left_side   = []
-        right_side  = []
-        
-        #if not self.node_objects[0].lies_in_plane(partition_plane):
-        #print("Triangle: %s" % self.node_objects[0])
-        #print("Plane: %s" % partition_plane)
-        #print("Distances: %f %f %f" % tuple([partition_plane.get_signed_distance(v) for v in self.node_objects[0].vertices]))
-        
-        for geom_object in self.node_objects:
-            if geom_object.lies_in_plane(partition_plane):
-                keep.append(geom_object)
-            else:
-                if geom_object.intersects_plane(partition_plane):
-                    intersections = geom_object.get_plane_intersections(partition_plane)
-                    if False and len(intersections) == 2:
-                        new_objects = geom_object.split(*intersections)
-                    else:
-                        new_objects = [geom_object, ]
-                    for new_object in new_objects:
-                        if partition_plane.get_side(new_object) == 1:
-                            right_side.append(new_object)
-                        else:
-                            left_side.append(new_object)
-                else:
-                    if partition_plane.get_side(geom_object) == 1:
-                        right_side.append(geom_object)
-                    else:
-                        left_side.append(geom_object)
-        
-        if not len(keep) > 0:
+        corners = self._get_node_corners()
+        distances = inner(corners, partition_plane.normal) + partition_plane.d
+        keep = (abs(distances) <= GeometricObject.intersection_tolerance).all(1)
+        right_side = ~keep & (distances[:, 0] > 0)
+        left_side = ~keep & ~right_side
+        if not keep.any():
             assert(False)
+        
+        if right_side.any():
+            self.right_child = self._create_child(flatnonzero(right_side))
+            self.right_extent = distances[right_side].min() - GeometricObject.intersection_tolerance
+        if left_side.any():
+            self.left_child  = self._create_child(flatnonzero(left_side))
+            self.left_extent = distances[left_side].max() + GeometricObject.intersection_tolerance
+        kept = flatnonzero(keep)
+        node_objects = self.node_objects
         del(self.node_objects)
-        self.node_objects = keep
-        if len(right_side) > 0:
-            self.right_child = TriangleBspTree(right_side, scene=self.scene)
-        if len(left_side) > 0:
-            self.left_child  = TriangleBspTree(left_side, scene=self.scene)
-        #print("same: %d, left: %d, right %d" % (len(keep), len(left_side), len(right_side)))
+        self.node_objects = [node_objects[index] for index in kept.tolist()]
+        self._indices = self._indices[kept]
     
     def draw(self, occluded=False):
-        """
+        """Draws the tree back to front in painter's order. The nodes are
+        visited from an explicit stack: each node draws its plane normal,
+        then its left subtree, its own triangles and its right subtree.
+        
         :Parameters:
           occluded : boolean
             whether or not this tree is occluded
         """
-        
-        # draw plane normal
+        # the entries are (node, occluded, left_is_occluded), where
+        # left_is_occluded is None, until the left subtree has been drawn
+        stack = [(self, occluded, None)]
+        while stack:
+            node, node_occluded, left_is_occluded = stack.pop()
+            if left_is_occluded is None:
+                node._draw_plane_normal()
+                #left_is_occluded = self.partition_plane.get_signed_distance(self.scene.eye[0:3]) < 0
+                left_is_occluded = inner(node.node_objects[0].vertices[0] - node.scene.eye[0:3], node.partition_plane.normal) > 0
+                stack.append((node, node_occluded, left_is_occluded))
+                if node.left_child is not None:
+                    stack.append((node.left_child, left_is_occluded, None))
+            else:
+                node._draw_node_objects(node_occluded)
+                if node.right_child is not None:
+                    stack.append((node.right_child, not left_is_occluded, None))
+    
+    def _draw_plane_normal(self):
         glPushAttrib(GL_ENABLE_BIT)
         glPushMatrix()
         glDisable(GL_LIGHTING)
@@ -103,13 +266,8 @@ class TriangleBspTree(BspTree):
         #glutWireSphere(0.075, 16, 16)
         glPopMatrix()
         glPopAttrib()
-        
-        #left_is_occluded = self.partition_plane.get_signed_distance(self.scene.eye[0:3]) < 0
-        left_is_occluded = inner(self.node_objects[0].vertices[0] - self.scene.eye[0:3], self.partition_plane.normal) > 0
-        
-        if self.left_child:
-            self.left_child.draw(left_is_occluded)
-        
+    
+    def _draw_node_objects(self, occluded):
         #glDisable(GL_LIGHTING)
         #glPushAttrib(GL_CURRENT_BIT)
         glBegin(GL_TRIANGLES)
@@ -127,6 +285,154 @@ class TriangleBspTree(BspTree):
         glEnd()
         #glPopAttrib()
         #glEnable(GL_LIGHTING)
+    
+    def _get_subtree_nodes(self):
+        """Returns the nodes of the subtree in pre-order."""
+        nodes = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            for child in (node.right_child, node.left_child):
+                if child is not None:
+                    stack.append(child)
+        return nodes
+    
+    def _prepare_rays(self):
+        """Collects the triangles of the subtree into a TriangleArray for the
+        ray queries and counts the triangles of every subtree.
+        """
+        nodes = self._get_subtree_nodes()
+        for node in reversed(nodes):
+            node._subtree_size = len(node.node_objects)
+            for child in (node.left_child, node.right_child):
+                if child is not None:
+                    node._subtree_size += child._subtree_size
+        self._triangles = TriangleArray.from_triangles([geom_object for node in nodes for geom_object in node.node_objects])
+    
+    def get_closest_hits(self, origins, directions):
+        """Intersects a packet of rays origins[i] + t * directions[i] (t >= 0)
+        with the triangles like TriangleArray.get_closest_hits. The tree is
+        walked once per ray.
+        """
+        directions = asarray(directions, dtype=float).reshape((-1, 3))
+        origins = asarray(origins, dtype=float) + zeros(directions.shape)
+        distances = empty(len(directions))
+        distances.fill(inf)
+        indices = empty(len(directions), dtype=int)
+        indices.fill(-1)
+        barycentrics = zeros((len(directions), 2))
+        if not len(self.triangles):
+            return (distances, indices, barycentrics)
+        for ray, (origin, direction) in enumerate(zip(origins.tolist(), directions.tolist())):
+            hit = self._traverse(origin, direction, inf, False)
+            if hit is not None:
+                indices[ray], distances[ray], barycentrics[ray, 0], barycentrics[ray, 1] = hit
+        return (distances, indices, barycentrics)
+    
+    def get_occlusions(self, points1, points2):
+        """Tests a packet of segments points1[i] to points2[i] for blocking
+        triangles like TriangleArray.get_occlusions. The walk of a segment
+        stops at its first hit.
+        """
+        points1 = asarray(points1, dtype=float)
+        directions = (asarray(points2, dtype=float) - points1).reshape((-1, 3))
+        origins = points1 + zeros(directions.shape)
+        occluded = zeros(len(directions), dtype=bool)
+        if not len(self.triangles):
+            return occluded
+        for ray, (origin, direction) in enumerate(zip(origins.tolist(), directions.tolist())):
+            occluded[ray] = self._traverse(origin, direction, 1.0, True) is not None
+        return occluded
+    
+    def _get_ray_data(self):
+        """Returns the partition plane and the corners and edges of the node
+        objects as Python numbers, that are faster to use one by one.
+        """
+        if self._ray_data is None:
+            plane = self.partition_plane
+            self._ray_data = (plane.normal.tolist(), plane.d,
+                              [(geom_object.vertices[0].tolist(), geom_object.edges[0].tolist(), geom_object.edges[1].tolist())
+                               for geom_object in self.node_objects])
+        return self._ray_data
+    
+    def _get_child_interval(self, start, slope, extent, below):
+        """Returns the (t_min, t_max) interval, in which the signed distance
+        start + t * slope of the ray is below (or above) the extent.
+        """
+        if slope == 0:
+            if (start <= extent) == below:
+                return (-inf, inf)
+            return (inf, -inf)
+        t = (extent - start) / slope
+        if (slope > 0) == below:
+            return (-inf, t)
+        return (t, inf)
+    
+    def _traverse(self, origin, direction, t_max, any_hit):
+        """Walks the tree with the ray origin + t * direction front to back:
+        the child on the side of the origin first, then the node objects and
+        last the child on the far side. Children, whose extents the ray only
+        reaches behind the closest hit so far, are skipped. The nodes to
+        visit are kept on an explicit stack.
         
-        if self.right_child:
-            self.right_child.draw(not left_is_occluded)
+        :Parameters:
+          origin, direction : list
+            the ray as lists of three numbers
+          t_max : float
+            the largest t of a hit
+          any_hit : boolean
+            whether to return the first hit with t <= t_max instead of the
+            closest hit
+        
+        :return: an (index, t, u, v) tuple or None
+        """
+        best = None
+        # the entries are (node, index of its first triangle, t_min, t_max
+        # of the part of the ray, that can hit the subtree, whether only the
+        # node objects are left)
+        stack = [(self, 0, 0.0, t_max, False)]
+        while stack:
+            node, first, node_min, node_max, objects_only = stack.pop()
+            if objects_only:
+                hit = node._intersect_node_objects(origin, direction, t_max, first)
+                if hit is not None:
+                    best = hit
+                    if any_hit:
+                        return best
+                    t_max = hit[1]
+                continue
+            node_max = min(node_max, t_max)
+            if node_min > node_max:
+                continue
+            
+            normal, d, node_objects = node._get_ray_data()
+            start_distance = normal[0] * origin[0] + normal[1] * origin[1] + normal[2] * origin[2] + d
+            slope = normal[0] * direction[0] + normal[1] * direction[1] + normal[2] * direction[2]
+            children = []
+            start = first + len(node_objects)
+            if node.left_child is not None:
+                child_min, child_max = node._get_child_interval(start_distance, slope, node.left_extent, True)
+                children.append((node.left_child, start, max(child_min, node_min), min(child_max, node_max), False))
+                start += node.left_child._subtree_size
+            if node.right_child is not None:
+                child_min, child_max = node._get_child_interval(start_distance, slope, node.right_extent, False)
+                children.append((node.right_child, start, max(child_min, node_min), min(child_max, node_max), False))
+            # the near child is the one, that the ray reaches first, and is
+            # pushed last
+            children.sort(key=lambda child: child[2], reverse=True)
+            children.insert(len(children) - 1, (node, first, node_min, node_max, True))
+            stack.extend([child for child in children if child[2] <= child[3]])
+        return best
+    
+    def _intersect_node_objects(self, origin, direction, t_max, first):
+        """Returns the closest hit with t <= t_max of the ray with the node
+        objects as (index, t, u, v) tuple or None.
+        """
+        hit = None
+        for index, (v0, edge1, edge2) in enumerate(self._get_ray_data()[2]):
+            node_hit = get_ray_triangle_hit(origin, direction, v0, edge1, edge2)
+            if node_hit is not None and node_hit[0] <= t_max:
+                hit = (first + index, ) + node_hit
+                t_max = node_hit[0]
+        return hit
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""
+This is a bounding volume hierarchy (BVH) over the triangles of a
+TriangleArray. It is built top-down with the surface area heuristic and kept
+in flat arrays instead of node objects: node i is bounded by node_lower[i]
+and node_upper[i]. Inner nodes have node_count[i] == 0 and their two children
+at node_child[i] and node_child[i] + 1. Leaves hold node_count[i] triangles
+starting at node_child[i] in `triangles`, which is reordered, so the
+triangles of every node are contiguous.
+
+The queries are the ones of geometry.TriangleAccelerator.
+
+The comments in this file are written in the reStructured text format and adhere
+to the commenting style used by epydoc.
+"""
+
+import logging
+import time
+
+from numpy import arange, argmin, argsort, asarray, concatenate, cumsum, empty, errstate, flatnonzero, inf, \
+    isinf, lexsort, maximum, minimum, where, zeros
+
+from geometry import TriangleAccelerator, TriangleArray, get_ray_triangle_hits
+
+def get_surface_areas(lower, upper):
+    """Returns the surface areas of the (N, 3) boxes."""
+    extents = upper - lower
+    return 2.0 * (extents[:, 0] * extents[:, 1] + extents[:, 1] * extents[:, 2] + extents[:, 2] * extents[:, 0])
+
+class TriangleBvh(TriangleAccelerator):
+    """A bounding volume hierarchy over a TriangleArray."""
+    # the number of triangles, up to which a node becomes a leaf
+    max_leaf_size = 4
+    # queries with fewer rays traverse the tree ray by ray
+    packet_threshold = 8
+    # the number of rays traversed together
+    packet_size = 4096
+
+    def __init__(self, triangles, max_leaf_size=None):
+        """
+        :Parameters:
+          triangles : TriangleArray
+            the triangles to build the hierarchy over (other triangle lists
+            are converted)
+
+        :Keywords:
+          max_leaf_size : int
+            the number of triangles, up to which a node becomes a leaf
+        """
+        self._log = logging.getLogger('TriangleBvh')
+        if not isinstance(triangles, TriangleArray):
+            triangles = TriangleArray.from_triangles(triangles)
+        if max_leaf_size is not None:
+            self.max_leaf_size = max_leaf_size
+        start = time.time()
+        order = self._build(triangles)
+        self.triangles = triangles[order]
+        self.build_time = time.time() - start
+        self._node_list = None
+        self._log.info(u"Built a BVH of %d nodes and depth %d over %d triangles in %.2f s." % (len(self.node_count), self.depth, len(triangles), self.build_time))
+
+    def _build(self, triangles):
+        """Builds the node arrays and returns the triangle order of the
+        leaves. Nodes are split at the position of the least surface area
+        cost along the centroid order of any axis, until they hold at most
+        max_leaf_size triangles.
+        """
+        lower, upper = triangles.get_triangle_bounds()
+        centroids = triangles.get_centroids()
+        order = arange(len(triangles))
+        node_lower = [None]
+        node_upper = [None]
+        node_child = [0]
+        node_count = [0]
+
+        self.depth = 0
+        # (node, start, end, depth) of the nodes still to build
+        stack = [(0, 0, len(triangles), 1)]
+        while stack:
+            node, start, end, depth = stack.pop()
+            self.depth = max(self.depth, depth)
+            indices = order[start:end]
+            if len(indices):
+                node_lower[node] = lower[indices].min(0)
+                node_upper[node] = upper[indices].max(0)
+            else:
+                node_lower[node] = node_upper[node] = zeros(3)
+            if end - start <= self.max_leaf_size:
+                node_child[node] = start
+                node_count[node] = end - start
+                continue
+
+            sorted_indices, position = self._find_split(indices, lower, upper, centroids)
+            order[start:end] = sorted_indices
+            child = len(node_child)
+            node_lower.extend([None, None])
+            node_upper.extend([None, None])
+            node_child.extend([0, 0])
+            node_count.extend([0, 0])
+            node_child[node] = child
+            stack.append((child + 1, start + position, end, depth + 1))
+            stack.append((child, start, start + position, depth + 1))
+
+        self.node_lower = asarray(node_lower, dtype=float)
+        self.node_upper = asarray(node_upper, dtype=float)
+        self.node_child = asarray(node_child, dtype=int)
+        self.node_count = asarray(node_count, dtype=int)
+        return order
+
+    def _find_split(self, indices, lower, upper, centroids):
+        """Returns the triangle indices sorted along the best axis and the
+        number of triangles going to the left child. The surface area cost
+        of every split position is computed from prefix and suffix bounds.
+        """
+        counts = arange(1, len(indices))
+        best = None
+        for axis in range(3):
+            sorted_indices = indices[argsort(centroids[indices, axis], kind='mergesort')]
+            sorted_lower = lower[sorted_indices]
+            sorted_upper = upper[sorted_indices]
+            left_areas = get_surface_areas(minimum.accumulate(sorted_lower), maximum.accumulate(sorted_upper))
+            right_areas = get_surface_areas(minimum.accumulate(sorted_lower[::-1])[::-1], maximum.accumulate(sorted_upper[::-1])[::-1])
+            costs = left_areas[:-1] * counts + right_areas[1:] * counts[::-1]
+            position = argmin(costs)
+            if best is None or costs[position] < best[0]:
+                best = (costs[position], sorted_indices, position + 1)
+        return (best[1], best[2])
+
+    def get_closest_hits(self, origins, directions):
+        """Intersects a packet of rays origins[i] + t * directions[i] (t >= 0)
+        with the triangles like TriangleArray.get_closest_hits. Only the
+        triangles in nodes, that a ray enters before its closest hit found
+        so far, are tested.
+        """
+        directions = asarray(directions, dtype=float).reshape((-1, 3))
+        origins = asarray(origins, dtype=float) + zeros(directions.shape)
+        distances = empty(len(directions))
+        distances.fill(inf)
+        indices = empty(len(directions), dtype=int)
+        indices.fill(-1)
+        barycentrics = zeros((len(directions), 2))
+        if not len(self.triangles):
+            return (distances, indices, barycentrics)
+
+        if len(directions) < self.packet_threshold:
+            for ray in range(len(directions)):
+                hit = self._traverse(origins[ray], directions[ray], False)
+                if hit is not None:
+                    indices[ray], distances[ray], barycentrics[ray, 0], barycentrics[ray, 1] = hit
+            return (distances, indices, barycentrics)
+
+        inverse_directions = self._get_inverse_directions(directions)
+        for start in xrange(0, len(directions), self.packet_size):
+            rays = arange(start, min(start + self.packet_size, len(directions)))
+            nodes = zeros(len(rays), dtype=int)
+            while len(rays):
+                entries, exits = self._intersect_nodes(origins[rays], inverse_directions[rays], nodes)
+                entered = (entries <= exits) & (exits >= 0) & (entries <= distances[rays])
+                rays, nodes = rays[entered], nodes[entered]
+
+                leaves = self.node_count[nodes] > 0
+                pair_rays, pair_triangles = self._get_leaf_pairs(rays[leaves], nodes[leaves])
+                hits, t, u, v = get_ray_triangle_hits(origins[pair_rays], directions[pair_rays], self.triangles.v0[pair_triangles],
+                                                      self.triangles.edges1[pair_triangles], self.triangles.edges2[pair_triangles])
+                closer = flatnonzero(hits & (t < distances[pair_rays]))
+                if len(closer):
+                    # keep the closest hit per ray, ties go to the first triangle
+                    closer = closer[lexsort((pair_triangles[closer], t[closer], pair_rays[closer]))]
+                    first = concatenate(([True], pair_rays[closer][1:] != pair_rays[closer][:-1]))
+                    closest = closer[first]
+                    hit_rays = pair_rays[closest]
+                    distances[hit_rays] = t[closest]
+                    indices[hit_rays] = pair_triangles[closest]
+                    barycentrics[hit_rays, 0] = u[closest]
+                    barycentrics[hit_rays, 1] = v[closest]
+
+                inner_rays, inner_nodes = rays[~leaves], nodes[~leaves]
+                rays = concatenate((inner_rays, inner_rays))
+                nodes = concatenate((self.node_child[inner_nodes], self.node_child[inner_nodes] + 1))
+        return (distances, indices, barycentrics)
+
+    def get_occlusions(self, points1, points2):
+        """Tests a packet of segments points1[i] to points2[i] for blocking
+        triangles like TriangleArray.get_occlusions. A segment leaves the
+        traversal as soon as a blocker is found.
+        """
+        points1 = asarray(points1, dtype=float)
+        points2 = asarray(points2, dtype=float)
+        directions = (points2 - points1).reshape((-1, 3))
+        origins = points1 + zeros(directions.shape)
+        directions = directions + zeros(origins.shape)
+        occluded = zeros(len(directions), dtype=bool)
+        if not len(self.triangles):
+            return occluded
+
+        if len(directions) < self.packet_threshold:
+            for ray in range(len(directions)):
+                occluded[ray] = self._traverse(origins[ray], directions[ray], True) is not None
+            return occluded
+
+        inverse_directions = self._get_inverse_directions(directions)
+        for start in xrange(0, len(directions), self.packet_size):
+            rays = arange(start, min(start + self.packet_size, len(directions)))
+            nodes = zeros(len(rays), dtype=int)
+            while len(rays):
+                entries, exits = self._intersect_nodes(origins[rays], inverse_directions[rays], nodes)
+                entered = (entries <= exits) & (exits >= 0) & (entries <= 1) & ~occluded[rays]
+                rays, nodes = rays[entered], nodes[entered]
+
+                leaves = self.node_count[nodes] > 0
+                pair_rays, pair_triangles = self._get_leaf_pairs(rays[leaves], nodes[leaves])
+                hits, t, u, v = get_ray_triangle_hits(origins[pair_rays], directions[pair_rays], self.triangles.v0[pair_triangles],
+                                                      self.triangles.edges1[pair_triangles], self.triangles.edges2[pair_triangles])
+                occluded[pair_rays[hits & (t <= 1)]] = True
+
+                inner = ~leaves & ~occluded[rays]
+                inner_rays, inner_nodes = rays[inner], nodes[inner]
+                rays = concatenate((inner_rays, inner_rays))
+                nodes = concatenate((self.node_child[inner_nodes], self.node_child[inner_nodes] + 1))
+        return occluded
+
+    def _get_inverse_directions(self, directions):
+        # zero components give infinite inverses, these axes are handled as
+        # parallel to the slabs by _intersect_nodes and _traverse
+        with errstate(divide='ignore', over='ignore'):
+            return 1.0 / asarray(directions, dtype=float)
+
+    def _intersect_nodes(self, origins, inverse_directions, nodes):
+        """Returns the ray parameters, at which the rays enter and leave the
+        bounds of the given nodes. A ray parallel to an axis spans the whole
+        slab of that axis, if its origin lies inside it (including the
+        faces), and misses the node otherwise.
+        """
+        lower, upper = self.node_lower[nodes], self.node_upper[nodes]
+        with errstate(invalid='ignore'):
+            t1 = (lower - origins) * inverse_directions
+            t2 = (upper - origins) * inverse_directions
+        parallel = isinf(inverse_directions)
+        inside = (lower <= origins) & (origins <= upper)
+        entries = where(parallel, where(inside, -inf, inf), minimum(t1, t2))
+        exits = where(parallel, where(inside, inf, -inf), maximum(t1, t2))
+        return (entries.max(1), exits.min(1))
+
+    def _get_leaf_pairs(self, rays, nodes):
+        """Returns the (ray, triangle) pairs of all triangles in the given
+        leaves.
+        """
+        counts = self.node_count[nodes]
+        offsets = arange(counts.sum()) - (cumsum(counts) - counts).repeat(counts)
+        return (rays.repeat(counts), self.node_child[nodes].repeat(counts) + offsets)
+
+    def _get_node_list(self):
+        """Returns the node arrays as lists of Python numbers, that are faster
+        to access one by one.
+        """
+        if self._node_list is None:
+            self._node_list = (self.node_lower.tolist(), self.node_upper.tolist(),
+                               self.node_child.tolist(), self.node_count.tolist())
+        return self._node_list
+
+    def _traverse(self, origin, direction, any_hit):
+        """Traverses the tree with a single ray, nearer children first.
+
+        :Parameters:
+          origin : array
+            the origin of the ray
+          direction : array
+            the direction of the ray
+          any_hit : boolean
+            whether to return the first hit with t <= 1 instead of the closest
+            hit
+
+        :return: an (index, t, u, v) tuple or None
+        """
+        node_lower, node_upper, node_child, node_count = self._get_node_list()
+        origin_list = origin.tolist()
+        inverse_direction = self._get_inverse_directions(direction).tolist()
+        parallel_axes = [axis for axis in (0, 1, 2) if abs(inverse_direction[axis]) == inf]
+        slab_axes = [axis for axis in (0, 1, 2) if axis not in parallel_axes]
+        best_t = any_hit and 1.0 or inf
+        best = None
+
+        def get_entry(node):
+            entry, exit = -inf, inf
+            lower, upper = node_lower[node], node_upper[node]
+            for axis in parallel_axes:
+                if not lower[axis] <= origin_list[axis] <= upper[axis]:
+                    return None
+            for axis in slab_axes:
+                t1 = (lower[axis] - origin_list[axis]) * inverse_direction[axis]
+                t2 = (upper[axis] - origin_list[axis]) * inverse_direction[axis]
+                if t1 > t2:
+                    t1, t2 = t2, t1
+                if t1 > entry:
+                    entry = t1
+                if t2 < exit:
+                    exit = t2
+            if entry > exit or exit < 0:
+                return None
+            return entry
+
+        root_entry = get_entry(0)
+        stack = root_entry is not None and [(root_entry, 0)] or []
+        while stack:
+            entry, node = stack.pop()
+            if entry > best_t:
+                continue
+            count = node_count[node]
+            if count:
+                start = node_child[node]
+                triangles = slice(start, start + count)
+                hits, t, u, v = get_ray_triangle_hits(origin, direction, self.triangles.v0[triangles],
+                                                      self.triangles.edges1[triangles], self.triangles.edges2[triangles])
+                t = where(hits, t, inf)
+                index = argmin(t)
+                if hits[index] and t[index] <= best_t and (best is None or t[index] < best[1]):
+                    best = (start + index, t[index], u[index], v[index])
+                    if any_hit:
+                        return best
+                    best_t = t[index]
+                continue
+            child = node_child[node]
+            children = [(get_entry(child), child), (get_entry(child + 1), child + 1)]
+            # the nearer child is pushed last, so it is visited first
+            children.sort(reverse=True)
+            for child_entry, child in children:
+                if child_entry is not None and child_entry <= best_t:
+                    stack.append((child_entry, child))
+        return best
@@ -36,6 +36,7 @@ from OpenGL.GLUT import *
 from eventdispatcher import EventDispatcher
 from handler import DefaultHandler
 from scene_ex5 import RaytraceScene
+from writer import ImageWriter
 
 class Application(object):
     def __init__(self):
@@ -45,6 +46,7 @@ class Application(object):
         self._init_log()
         self._init_config(['cg1_defaults.conf'])
         self._init_windows()
+        self._init_writer()
         self._init_callbacks()
         self._init_scene()
             
@@ -70,9 +72,6 @@ class Application(object):
         self._log.info(u"Reading config files %s...", config_files)
         self._config = SafeConfigParser()
         self._config.read(config_files)
-        
-        sys.setrecursionlimit(4000)
-        self._log.info(u"Recursion limit is now %d." % sys.getrecursionlimit())
     
     def _init_windows(self):
         self._log.info(u"Initializing windows...")
@@ -82,6 +81,11 @@ class Application(object):
         glutInitWindowPosition(self._config.getint('window', 'x'), self._config.getint('window', 'y'))
         self._window = glutCreateWindow(self._config.get('window', 'title'))
     
+    def _init_writer(self):
+        self._image_writer = ImageWriter()
+        self._image_writer.start()
+        self._frame_recorder = None
+    
     def _init_callbacks(self):
         self._log.info(u"Initializing callbacks...")
         self._main_dispatcher = EventDispatcher()
@@ -119,6 +123,7 @@ class Application(object):
     
     def stop(self):
         self._log.info(u"Stopping...")
+        self._image_writer.close()
         sys.exit()
     
     def update(self, enabled):
@@ -145,6 +150,9 @@ class Application(object):
         if self._current_scene:
             self._current_scene.render()
         
+        if self._frame_recorder:
+            self._frame_recorder.capture()
+        
         glutSwapBuffers()
 
 if __name__ == '__main__':
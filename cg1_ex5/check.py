@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+This checks the mesh readers and the acceleration structures against their
+reference implementations on every OFF file of the bundled mesh directory.
+
+Every reader mode (see `reader_modes`) has to return the same faces and
+corners as the serial text parse of openOff.
+
+Every acceleration structure has to return the same results as the brute
+force test of TriangleArray, that intersects every ray with every triangle.
+The meshes are traced with random rays and with rays parallel to the
+coordinate axes, that lie in the planes through the vertex coordinates.
+Those planes hold the faces of the BVH nodes, so the parallel rays start on
+or graze node bounds. The rays are traced as packets and one by one, as the
+structures use different code paths for both. The BSP tree of the drawing
+code is a scene graph node, so it is only checked if PyOpenGL is installed.
+
+The script exits with status 1, if any result differs.
+
+The comments in this file are written in the reStructured text format and adhere
+to the commenting style used by epydoc.
+"""
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+from glob import glob
+from optparse import OptionParser
+
+from numpy import abs, array, array_equal, concatenate, eye, inf, isinf, random, where, zeros
+
+from raytracer import accelerators, get_accelerator
+from reader import openOff, openPly, write_ply
+
+try:
+    from bsp import TriangleBspTree
+except ImportError:
+    TriangleBspTree = None
+
+base_directory = os.path.dirname(os.path.abspath(__file__))
+mesh_directories = [os.path.join(base_directory, 'meshes')]
+
+def read_text(filename, workers):
+    vertices, faces = openOff(filename, cache=False).get_arrays()
+    return (faces, vertices[faces])
+
+def read_cached(filename, workers):
+    # the first reader builds the cache, the second one loads it
+    openOff(filename).get_arrays()
+    vertices, faces = openOff(filename).get_arrays()
+    return (faces, vertices[faces])
+
+def read_parallel(filename, workers):
+    mesh_reader = openOff(filename, cache=False, workers=workers)
+    mesh_reader.parallel_threshold = 0
+    vertices, faces = mesh_reader.get_arrays()
+    return (faces, vertices[faces])
+
+def read_stream(filename, workers):
+    # small batches, so the meshes are streamed in several of them
+    batches = list(openOff(filename, cache=False).iter_faces(batch_size=1000))
+    if not batches:
+        return (zeros((0, 3), dtype=int), zeros((0, 3, 3)))
+    return (concatenate([indices for indices, corners in batches]), concatenate([corners for indices, corners in batches]))
+
+def read_triangles(filename, workers):
+    triangles = openOff(filename, cache=False).get_triangles()
+    return (None, array([triangle.vertices for triangle in triangles], dtype=float).reshape((-1, 3, 3)))
+
+def read_ply(filename, workers):
+    vertices, faces = openOff(filename, cache=False).get_arrays()
+    directory = tempfile.mkdtemp()
+    try:
+        ply_filename = os.path.join(directory, 'mesh.ply')
+        write_ply(ply_filename, vertices, faces)
+        vertices, faces = openPly(ply_filename).get_arrays()
+        return (faces.copy(), vertices[faces])
+    finally:
+        shutil.rmtree(directory)
+
+reader_modes = {
+    'cached'    : read_cached,
+    'parallel'  : read_parallel,
+    'stream'    : read_stream,
+    'triangles' : read_triangles,
+    'ply'       : read_ply,
+    }
+
+def check_readers(filename, mode_names, workers):
+    """Reads the mesh with every reader mode and returns the number of modes,
+    whose faces (if a mode keeps them) or corners differ from the text parse.
+    """
+    reference_faces, reference_corners = read_text(filename, workers)
+    errors = 0
+    for mode in mode_names:
+        faces, corners = reader_modes[mode](filename, workers)
+        differs = (faces is not None and not array_equal(faces, reference_faces)) or not array_equal(corners, reference_corners)
+        logging.info(u"%-30s %-10s %s" % (os.path.relpath(filename, base_directory), mode, differs and u"differs" or u"ok"))
+        errors += differs
+    return errors
+
+def get_random_rays(triangles, count, generator):
+    """Returns (origins, directions) of rays from around the mesh towards
+    points near its center. A quarter of them starts inside the bounding box.
+    """
+    lower, upper = triangles.get_bounding_box()
+    center = (lower + upper) / 2
+    extent = (upper - lower).max()
+    origins = center + generator.randn(count, 3) * extent
+    origins[:count // 4] = center + generator.randn(count // 4, 3) * extent * 0.1
+    directions = center + generator.randn(count, 3) * extent * 0.2 - origins
+    return (origins, directions)
+
+def get_axis_rays(triangles, count, generator):
+    """Returns (origins, directions) of rays parallel to a coordinate axis.
+    They start outside or on the bounding box, and every ray lies in the
+    plane through a vertex coordinate of another axis. Half of the rays pass
+    through the vertex itself.
+    """
+    lower, upper = triangles.get_bounding_box()
+    extent = (upper - lower).max()
+    vertices = triangles.get_vertices()
+    origins = vertices[generator.randint(len(vertices), size=count)]
+    axes = generator.randint(3, size=count)
+    signs = generator.randint(2, size=count) * 2 - 1
+    directions = eye(3)[axes] * signs[:, None]
+    rows = range(count)
+    # the rays start before the mesh or on the face of its bounding box
+    starts = array([lower, upper])[(signs < 0).astype(int), axes]
+    origins[rows, axes] = starts - signs * extent * generator.randint(2, size=count)
+    # the other half leaves the vertex along the remaining free axis
+    free_axes = (axes + 1 + generator.randint(2, size=count)) % 3
+    moved = generator.rand(count) < 0.5
+    origins[rows, free_axes] = where(moved, lower[free_axes] + generator.rand(count) * (upper - lower)[free_axes],
+                                     origins[rows, free_axes])
+    return (origins, directions)
+
+def compare_hits(reference, result, tolerance):
+    """Returns the number of rays, whose closest hit differs. Hits at the
+    same distance on different triangles (e.g. on a shared edge) count as
+    equal.
+    """
+    reference_distances, reference_indices = reference[0], reference[1]
+    distances, indices = result[0], result[1]
+    missed = (reference_indices < 0) != (indices < 0)
+    hit = (reference_indices >= 0) & (indices >= 0)
+    differing = zeros(len(distances), dtype=bool)
+    differing[hit] = abs(reference_distances[hit] - distances[hit]) > tolerance
+    return int((missed | differing).sum())
+
+def check_accelerator(triangles, accelerator, origins, directions, tolerance, generator):
+    """Returns the number of differing closest hits of the packet, of the
+    single rays and of the occlusion tests of segments along the rays.
+    """
+    reference = triangles.get_closest_hits(origins, directions)
+    errors = compare_hits(reference, accelerator.get_closest_hits(origins, directions), tolerance)
+
+    single = [accelerator.get_closest_hit(origin, direction) for origin, direction in zip(origins, directions)]
+    single_distances = array([hit is None and inf or hit[1] for hit in single])
+    single_indices = array([hit is None and -1 or hit[0] for hit in single])
+    errors += compare_hits(reference, (single_distances, single_indices), tolerance)
+
+    # the segments end before or after the closest hit, but not on it
+    lengths = where(isinf(reference[0]), 1.0, reference[0]) * where(generator.rand(len(origins)) < 0.5, 0.5, 1.5)
+    points2 = origins + directions * lengths[:, None]
+    errors += int((triangles.get_occlusions(origins, points2) != accelerator.get_occlusions(origins, points2)).sum())
+    return errors
+
+def create_accelerator(triangles, name):
+    """Returns the triangles in the acceleration structure with the given
+    name like raytracer.get_accelerator, which also builds the BSP tree.
+    """
+    if name != 'bsp':
+        return get_accelerator(triangles, name)
+    bsp_tree = TriangleBspTree(list(triangles), scene=None)
+    bsp_tree.autopartition()
+    return bsp_tree
+
+def check_mesh(filename, accelerator_names, ray_count, seed):
+    """Checks all accelerators on the mesh and returns the number of
+    differing results.
+    """
+    triangles = openOff(filename, cache=False).get_mesh().get_triangle_array()
+    if not len(triangles):
+        return 0
+    generator = random.RandomState(seed)
+    lower, upper = triangles.get_bounding_box()
+    tolerance = 1e-9 * max((upper - lower).max(), 1.0)
+    ray_sets = [('random', get_random_rays(triangles, ray_count, generator)),
+                ('axis', get_axis_rays(triangles, ray_count, generator))]
+    errors = 0
+    for name in accelerator_names:
+        accelerator = create_accelerator(triangles, name)
+        for ray_set, (origins, directions) in ray_sets:
+            differences = check_accelerator(triangles, accelerator, origins, directions, tolerance, generator)
+            logging.info(u"%-30s %-6s %-7s %s" % (os.path.relpath(filename, base_directory), name, ray_set,
+                                                  differences and u"%d differences" % differences or u"ok"))
+            errors += differences
+    return errors
+
+def main():
+    parser = OptionParser(usage=u"%prog [options] [mesh files]")
+    names = sorted([name for name in accelerators if accelerators[name] is not None])
+    if TriangleBspTree is not None:
+        names.append('bsp')
+    parser.add_option('-m', '--modes', dest='modes', default=','.join(sorted(reader_modes)), help=u"comma separated reader modes (%s)" % ', '.join(sorted(reader_modes)))
+    parser.add_option('-a', '--accelerators', dest='accelerators', default=','.join(names), help=u"comma separated acceleration structures (%s)" % ', '.join(names))
+    parser.add_option('-n', '--rays', dest='rays', type='int', default=400, help=u"number of rays per ray set")
+    parser.add_option('-s', '--seed', dest='seed', type='int', default=3, help=u"seed of the random rays")
+    parser.add_option('-w', '--workers', dest='workers', type='int', default=4, help=u"number of processes of the parallel reader mode")
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    mode_names = [mode.strip() for mode in options.modes.split(',') if mode.strip()]
+    for mode in mode_names:
+        if mode not in reader_modes:
+            parser.error(u"unknown reader mode '%s'" % mode)
+    accelerator_names = [name.strip() for name in options.accelerators.split(',') if name.strip()]
+    for name in accelerator_names:
+        if name not in names:
+            parser.error(u"unknown accelerator '%s'" % name)
+    if TriangleBspTree is None:
+        logging.info(u"PyOpenGL is not installed, the BSP tree is not checked.")
+    filenames = args or sorted(sum([glob(os.path.join(directory, '*.off')) for directory in mesh_directories], []))
+
+    reader_errors = sum([check_readers(filename, mode_names, options.workers) for filename in filenames])
+    errors = sum([check_mesh(filename, accelerator_names, options.rays, options.seed) for filename in filenames])
+    if reader_errors:
+        logging.error(u"%d reader modes differ from the text parse." % reader_errors)
+    if errors:
+        logging.error(u"%d results differ from the brute force test." % errors)
+    if reader_errors or errors:
+        sys.exit(1)
+    logging.info(u"All results match.")
+
+if __name__ == '__main__':
+    main()
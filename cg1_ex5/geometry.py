@@ -1,18 +1,28 @@
 import logging
 
-from numpy import cross, append, sign, inner, mean, pi, arctan2, sqrt,  abs, array, dot
+from numpy import cross, append, sign, inner, mean, pi, arctan2, sqrt,  abs, array, dot, zeros, minimum, maximum, newaxis, unique, \
+    asarray, stack, hstack, ones, integer, ascontiguousarray, dtype, void, sort, \
+    einsum, errstate, flatnonzero, argmin, arange, empty, inf, where, argsort, bincount, column_stack
 from numpy.linalg import norm, inv
 
 from datastructures import MultiValueDict
 
 class GeometricObject(object):
+    __slots__ = ()
     intersection_tolerance = 0.00001
     def __init__(self):
         pass
 
 class Plane(GeometricObject):
+    """A plane given by the params (a, b, c, d). The normal and d are split
+    off once on construction.
+    """
+    __slots__ = ('params', 'normal', 'd')
+    
     def __init__(self, params):
-        self.params = params
+        self.params = asarray(params, dtype=float)
+        self.normal = self.params[0:3]
+        self.d = float(self.params[3])
     
     def _get_a(self):
         return self.params[0]
@@ -26,14 +36,6 @@ class Plane(GeometricObject):
         return self.params[2]
     c = property(_get_c)
     
-    def _get_d(self):
-        return self.params[3]
-    d = property(_get_d)
-    
-    def _get_normal(self):
-        return self.params[0:3]
-    normal = property(_get_normal)
-    
     def get_signed_distance(self, point):
         return (inner(self.normal, point) + self.d)# / norm(self.normal)
     
@@ -54,6 +56,8 @@ class Plane(GeometricObject):
         return str(self.params)
 
 class Polygon(GeometricObject):
+    __slots__ = ('vertices', )
+    
     def __init__(self, vertices):
         GeometricObject.__init__(self)
         self.vertices = vertices
@@ -76,16 +80,26 @@ class Polygon(GeometricObject):
         return True
 
 class Triangle(Polygon):
+    """A triangle, whose vertices are stored as one (3, 3) array. The edges
+    from the first corner, the normal and the plane offset are computed once
+    on construction. The plane of the triangle holds all points p with
+    inner(normal, p) == plane_offset.
+    """
+    __slots__ = ('edges', 'normal', 'plane_offset')
+    
     def __init__(self, vertices):
-        Polygon.__init__(self, vertices)
+        Polygon.__init__(self, asarray(vertices, dtype=float))
+        self.edges = self.vertices[1:3] - self.vertices[0]
         self.normal = self._computeNormal()
+        self.plane_offset = inner(self.normal, self.vertices[0])
     
     def _computeNormal(self):
-        normal = (cross(self.vertices[1] - self.vertices[0], self.vertices[2] - self.vertices[0]))
+        normal = cross(self.edges[0], self.edges[1])
         return normal / norm(normal)
     
     def get_plane(self):
-        return Plane(append(self.normal, [inner(self.normal, self.vertices[0]), ]))
+        # the signed distance of the plane is inner(normal, p) + d
+        return Plane(append(self.normal, [-self.plane_offset, ]))
     
     def get_plane_intersections(self, plane):
         intersections = []
@@ -117,6 +131,8 @@ class Triangle(Polygon):
         return "Vertices: %s, Normal: %s" % (str(self.vertices), str(self.normal))
 
 class Quad(Polygon):
+    __slots__ = ()
+    
     def __init__(self, vertices):
         Polygon.__init__(self, vertices)
     
@@ -125,7 +141,58 @@ class Quad(Polygon):
         triangle2 = Triangle(self.vertices[2:4] + self.vertices[0:1])
         return [triangle1, triangle2]
         
+def _changes_geometry(method):
+    """Wraps a mutating list method of TriangleList, so that it drops the
+    cached geometry after the call.
+    """
+    def changing(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self.geometry_changed()
+        return result
+    changing.__name__ = method.__name__
+    changing.__doc__ = method.__doc__
+    return changing
+
 class TriangleList(list):
+    """A list of triangles. The indexed mesh of the triangles and the maps
+    derived from it are cached; the mutating list methods drop the cache,
+    changing the vertices of a contained triangle needs a call to
+    geometry_changed.
+    """
+    _mesh = None
+    _vertex_normal_maps = None
+    _vertex_texture_maps = None
+    
+    append = _changes_geometry(list.append)
+    extend = _changes_geometry(list.extend)
+    insert = _changes_geometry(list.insert)
+    remove = _changes_geometry(list.remove)
+    pop = _changes_geometry(list.pop)
+    sort = _changes_geometry(list.sort)
+    reverse = _changes_geometry(list.reverse)
+    __setitem__ = _changes_geometry(list.__setitem__)
+    __delitem__ = _changes_geometry(list.__delitem__)
+    __setslice__ = _changes_geometry(list.__setslice__)
+    __delslice__ = _changes_geometry(list.__delslice__)
+    __iadd__ = _changes_geometry(list.__iadd__)
+    __imul__ = _changes_geometry(list.__imul__)
+    
+    def geometry_changed(self):
+        """Drops the cached mesh and vertex maps. Call this after changing
+        the vertices of a contained triangle in place.
+        """
+        self._mesh = None
+        self._vertex_normal_maps = None
+        self._vertex_texture_maps = None
+    
+    def get_mesh(self):
+        """Returns the triangles as IndexedTriangleMesh, built once by
+        IndexedTriangleMesh.from_corners and then cached.
+        """
+        if self._mesh is None:
+            self._mesh = IndexedTriangleMesh.from_corners(array([triangle.vertices for triangle in self], dtype=float).reshape((-1, 3, 3)))
+        return self._mesh
+    
     def get_vertices(self, distinct=False):
         """Returns a list of all vertices of all vertices of all triangles
         contained within the list.
@@ -156,35 +223,115 @@ class TriangleList(list):
                 result.appendlist(tuple(vertex), triangle)
         return result
     
-    def get_vertex_normal_map(self):
-        vertex_map = self.get_vertex_map()
-        normal_map = {}
-        for vertex, triangles in vertex_map.lists():
-            normals = [triangle.normal for triangle in triangles]
-            normal_map[tuple(vertex)] = mean([triangle.normal for triangle in triangles], axis=0)
-        return normal_map
+    def get_vertex_normal_map(self, weighting='uniform'):
+        """Returns a dictionary mapping every vertex tuple to the weighted
+        mean of the normals of the adjacent triangles. The map is cached per
+        weighting until geometry_changed is called.
+        
+        :Parameters:
+            weighting : string
+                one of IndexedTriangleMesh.weightings
+        """
+        if self._vertex_normal_maps is None:
+            self._vertex_normal_maps = {}
+        if weighting not in self._vertex_normal_maps:
+            if not len(self):
+                return {}
+            self._vertex_normal_maps[weighting] = self.get_mesh().get_vertex_normal_map(weighting)
+        return self._vertex_normal_maps[weighting]
     
     def get_vertex_sphere_map(self):
-        vertex_map = self.get_vertex_map()
-        texture_map = {}
-        for vertex in vertex_map.keys():
-            u = (pi + arctan2(vertex[1], vertex[0])) / (2 * pi)
-            v = arctan2(sqrt(vertex[0]**2 + vertex[1]**2), vertex[2]) / pi
-            texture_map[tuple(vertex)] = (u, v)
-        return texture_map
+        return self.get_vertex_texture_map('sphere')
+    
+    def get_vertex_texture_map(self, projection='sphere'):
+        """Returns a dictionary mapping every vertex tuple to its (u, v)
+        texture coordinates. The map is cached per projection until
+        geometry_changed is called.
+        
+        :Parameters:
+            projection : string
+                one of IndexedTriangleMesh.projections
+        """
+        if self._vertex_texture_maps is None:
+            self._vertex_texture_maps = {}
+        if projection not in self._vertex_texture_maps:
+            if not len(self):
+                return {}
+            self._vertex_texture_maps[projection] = self.get_mesh().get_vertex_texture_map(projection)
+        return self._vertex_texture_maps[projection]
 
     def get_bounding_box(self):
-        vertices = array(self.get_vertices(distinct=True))
-        vertices.sort(0)
-        return (vertices[0, :], vertices[-1, :])
+        """Returns the bounding box of all triangles, reduced over one stacked
+        (3N, 3) array of their corners.
+        
+        :return: a (minimum, maximum) pair of vertices or None for an empty
+            list
+        """
+        if not len(self):
+            return None
+        vertices = array([triangle.vertices for triangle in self], dtype=float).reshape((-1, 3))
+        return (vertices.min(0), vertices.max(0))
+
+    @staticmethod
+    def get_batch_bounding_box(face_batches):
+        """Returns the bounding box of a mesh given as a stream of face
+        batches, as yielded by `reader.openOff.iter_faces`. Only one batch is
+        held in memory at a time.
+        
+        :Parameters:
+            face_batches : iterable
+                (indices, corners) pairs of (B, 3) and (B, 3, 3) arrays
+        
+        :return: a (minimum, maximum) pair of vertices or None for a mesh
+            without faces
+        """
+        lower = upper = None
+        for indices, corners in face_batches:
+            if not len(corners):
+                continue
+            corners = corners.reshape((-1, 3))
+            if lower is None:
+                lower, upper = corners.min(0), corners.max(0)
+            else:
+                lower = minimum(lower, corners.min(0))
+                upper = maximum(upper, corners.max(0))
+        if lower is None:
+            return None
+        return (lower, upper)
+    
+    @staticmethod
+    def get_batch_vertex_normals(vertex_count, face_batches, weighting='uniform'):
+        """Returns the weighted mean of the adjacent face normals for every
+        vertex of a mesh given as a stream of face batches, as yielded by
+        `reader.openOff.iter_faces`. Every batch is scattered like in
+        get_vertex_normals; apart from the result only one batch is held in
+        memory at a time.
+        
+        :Parameters:
+            vertex_count : int
+                the number of vertices of the mesh
+            face_batches : iterable
+                (indices, corners) pairs of (B, 3) and (B, 3, 3) arrays
+            weighting : string
+                one of IndexedTriangleMesh.weightings
+        
+        :return: a (vertex_count, 3) array of normals, indexed like the
+            vertices
+        """
+        normal_sums = zeros((vertex_count, 3))
+        weight_sums = zeros(vertex_count)
+        for indices, corners in face_batches:
+            batch_normal_sums, batch_weight_sums = _scatter_vertex_normals(vertex_count, indices, corners, weighting)
+            normal_sums += batch_normal_sums
+            weight_sums += batch_weight_sums
+        return normal_sums / where(weight_sums > 0, weight_sums, 1)[:, newaxis]
 
     def transformed(self, transformation):
-        result = TriangleList()
-        for triangle in self:
-            new_vertices = [dot(transformation, append(vertex, [1.0, ]))[0:3] for vertex in triangle.vertices]
-            new_triangle = Triangle(new_vertices)
-            result.append(new_triangle)
-        return result
+        if not len(self):
+            return TriangleList()
+        corners = array([triangle.vertices for triangle in self], dtype=float).reshape((-1, 3))
+        new_corners = transform_points(corners, transformation).reshape((-1, 3, 3))
+        return TriangleList([Triangle(list(new_vertices)) for new_vertices in new_corners])
         
     def get_closest_intersection(self, point1, point2, vertex_normal_map):
         """Returns a (triangle, point) pair, where the triangle intersects the line defined by the two given points in the associated point closest to point1."""
@@ -192,7 +339,7 @@ class TriangleList(list):
         intersection_distance = None
         direction = point2 - point1
         for triangle in self:
-            d = triangle.get_plane().params[3]
+            d = triangle.plane_offset
             normal = triangle.normal
             w = inner(normal, direction)
             if w != 0:
@@ -214,4 +361,698 @@ class TriangleList(list):
                         intersection_normal = intersection_normal / norm(intersection_normal)
                         intersection = (triangle, intersection_point, intersection_normal)
         return intersection
+
+class TriangleArray(object):
+    """A triangle list stored as structure of arrays: the corners, face
+    normals and plane offsets of all triangles are kept in contiguous (N, 3)
+    and (N, ) arrays, so whole-mesh operations run as array operations.
+    Iterating and indexing with integers yields Triangle objects like a
+    TriangleList, indexing with slices or index arrays yields another
+    TriangleArray.
+    """
+    max_chunk_elements = 1 << 18
+    occlusion_block_size = 4096
+    
+    def __init__(self, v0, v1, v2, mesh=None):
+        """
+        :Parameters:
+            v0, v1, v2 : array
+                (N, 3) arrays holding the first, second and third corner of
+                every triangle
+        
+        :Keywords:
+            mesh : IndexedTriangleMesh
+                the mesh, whose faces hold the vertex indices of the corners;
+                by default equal corners are merged into one vertex
+        """
+        self.v0 = asarray(v0, dtype=float)
+        self.v1 = asarray(v1, dtype=float)
+        self.v2 = asarray(v2, dtype=float)
+        normals = cross(self.v1 - self.v0, self.v2 - self.v0)
+        self.normals = normals / norm(normals, axis=1)[:, newaxis]
+        # the plane of triangle i contains all points p with inner(normals[i], p) == plane_offsets[i]
+        self.plane_offsets = (self.normals * self.v0).sum(1)
+        self.edges1 = self.v1 - self.v0
+        self.edges2 = self.v2 - self.v0
+        self._mesh = mesh
+        self._vertex_normal_maps = {}
+        self._vertex_texture_maps = {}
+        self._bounding_box = None
+        self._triangle_bounds = None
+        self._centroids = None
+    
+    @classmethod
+    def from_triangles(cls, triangles):
+        """Creates a TriangleArray holding the vertices of the given triangles."""
+        if not len(triangles):
+            return cls(zeros((0, 3)), zeros((0, 3)), zeros((0, 3)))
+        v0, v1, v2 = [array([triangle.vertices[corner] for triangle in triangles]) for corner in range(3)]
+        return cls(v0, v1, v2)
+    
+    def __len__(self):
+        return len(self.v0)
+    
+    def __getitem__(self, index):
+        if isinstance(index, (int, long, integer)):
+            return Triangle([self.v0[index], self.v1[index], self.v2[index]])
+        mesh = None
+        if self._mesh is not None:
+            mesh = IndexedTriangleMesh(self._mesh.vertices, self._mesh.faces[index])
+        return self.__class__(self.v0[index], self.v1[index], self.v2[index], mesh)
+    
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self[index]
+    
+    def get_corners(self):
+        """Returns a (N, 3, 3) array holding the three corners of each triangle."""
+        return stack((self.v0, self.v1, self.v2), axis=1)
+    
+    def get_vertices(self, distinct=False):
+        """Returns the vertices of all triangles as (3N, 3) array.
+        
+        :Parameters:
+            distinct : boolean
+                toggle filtering of duplicate vertices
+        """
+        vertices = self.get_corners().reshape((-1, 3))
+        if distinct:
+            return unique_rows(vertices)
+        return vertices
+    
+    def get_vertex_map(self):
+        return TriangleList(self).get_vertex_map()
+    
+    def get_mesh(self):
+        """Returns the IndexedTriangleMesh, whose faces index the corners of
+        the triangles. Without a mesh given on construction, it is created
+        once from the corners.
+        """
+        if self._mesh is None:
+            self._mesh = IndexedTriangleMesh.from_corners(self.get_corners())
+        return self._mesh
+    
+    def get_vertex_normals(self, weighting='uniform'):
+        """Returns the (V, 3) vertex normals of the mesh (see get_mesh), as
+        used by get_interpolated_normal.
+        """
+        return self.get_mesh().get_vertex_normals(weighting)
+    
+    def get_vertex_normal_map(self, weighting='uniform'):
+        """Returns the vertex normal map of the mesh (see get_mesh) like
+        TriangleList.get_vertex_normal_map. It is computed once per weighting
+        and then cached.
+        """
+        if weighting not in self._vertex_normal_maps:
+            self._vertex_normal_maps[weighting] = self.get_mesh().get_vertex_normal_map(weighting)
+        return self._vertex_normal_maps[weighting]
+    
+    def get_vertex_sphere_map(self):
+        return self.get_vertex_texture_map('sphere')
+    
+    def get_vertex_texture_map(self, projection='sphere'):
+        """Returns the vertex texture map of the mesh (see get_mesh) like
+        TriangleList.get_vertex_texture_map. It is computed once per
+        projection and then cached.
+        """
+        if projection not in self._vertex_texture_maps:
+            self._vertex_texture_maps[projection] = self.get_mesh().get_vertex_texture_map(projection)
+        return self._vertex_texture_maps[projection]
+    
+    def get_bounding_box(self):
+        """Returns the bounding box of all triangles as (minimum, maximum)
+        pair or None if there are no triangles. It is computed once from the
+        triangle bounds and then cached.
+        """
+        if not len(self):
+            return None
+        if self._bounding_box is None:
+            lower, upper = self.get_triangle_bounds()
+            self._bounding_box = (lower.min(0), upper.max(0))
+        return self._bounding_box
+    
+    def get_triangle_bounds(self):
+        """Returns the axis aligned bounding boxes of all triangles as
+        (minimum, maximum) pair of (N, 3) arrays. They are computed once and
+        then cached.
+        """
+        if self._triangle_bounds is None:
+            self._triangle_bounds = (minimum(minimum(self.v0, self.v1), self.v2),
+                                     maximum(maximum(self.v0, self.v1), self.v2))
+        return self._triangle_bounds
+    
+    def get_centroids(self):
+        """Returns a (N, 3) array holding the centroid of every triangle. It
+        is computed once and then cached.
+        """
+        if self._centroids is None:
+            self._centroids = (self.v0 + self.v1 + self.v2) / 3.0
+        return self._centroids
+    
+    def get_closest_hit(self, origin, direction):
+        """Intersects the ray origin + t * direction (t >= 0) with all
+        triangles at once. This is a packet of one ray for get_closest_hits,
+        so single rays and packets share one Moeller-Trumbore test.
+        
+        :return: an (index, t, u, v) tuple for the closest hit or None, where
+            u and v are the barycentric weights of the second and third corner
+        """
+        distances, indices, barycentrics = self.get_closest_hits(origin, direction)
+        if indices[0] < 0:
+            return None
+        return (indices[0], distances[0], barycentrics[0, 0], barycentrics[0, 1])
+    
+    def get_closest_intersection(self, point1, point2, vertex_normals):
+        """Returns a (triangle, point, normal) tuple, where the triangle intersects the line defined by the two given points in the associated point closest to point1.
+        The normal is interpolated from the vertex_normals returned by get_vertex_normals. Unlike TriangleList, all triangles are tested in one vectorized pass.
+        """
+        direction = point2 - point1
+        hit = self.get_closest_hit(point1, direction)
+        if hit is None:
+            return None
+        index, t, u, v = hit
+        return (self[index], point1 + t * direction, self.get_interpolated_normal(index, u, v, vertex_normals))
+    
+    def get_interpolated_normal(self, index, u, v, vertex_normals):
+        """Returns the unit normal at the point with the barycentric weights
+        u and v (of the second and third corner) inside the given triangle.
+        The vertex_normals (see get_vertex_normals) are indexed by the face of
+        the triangle.
+        """
+        normal0, normal1, normal2 = vertex_normals[self.get_mesh().faces[index]]
+        intersection_normal = (1 - u - v)*normal0 + u*normal1 + v*normal2
+        return intersection_normal / norm(intersection_normal)
+    
+    def get_closest_hits(self, origins, directions):
+        """Intersects a packet of rays origins[i] + t * directions[i] (t >= 0)
+        with all triangles. The rays are processed in chunks of at most
+        `max_chunk_elements` ray/triangle pairs to bound the memory use.
+        
+        :Parameters:
+            origins : array
+                a (R, 3) array of ray origins or a single origin shared by
+                all rays
+            directions : array
+                a (R, 3) array of ray directions
+        
+        :return: a (distances, indices, barycentrics) tuple of a (R, ) array
+            of hit parameters t (inf for misses), a (R, ) array of triangle
+            indices (-1 for misses) and a (R, 2) array of the barycentric
+            weights of the second and third corner
+        """
+        directions = asarray(directions, dtype=float).reshape((-1, 3))
+        origins = asarray(origins, dtype=float) + zeros(directions.shape)
+        ray_count = len(directions)
+        distances = empty(ray_count)
+        distances.fill(inf)
+        indices = empty(ray_count, dtype=int)
+        indices.fill(-1)
+        barycentrics = zeros((ray_count, 2))
+        if not len(self):
+            return (distances, indices, barycentrics)
+        
+        chunk_size = max(1, self.max_chunk_elements // len(self))
+        for start in xrange(0, ray_count, chunk_size):
+            chunk = slice(start, start + chunk_size)
+            hits, t, u, v = self._intersect_packet(origins[chunk], directions[chunk], slice(None))
+            t[~hits] = inf
+            closest = argmin(t, axis=1)
+            rows = arange(len(closest))
+            found = hits[rows, closest]
+            distances[chunk] = t[rows, closest]
+            indices[chunk] = where(found, closest, -1)
+            barycentrics[chunk, 0] = where(found, u[rows, closest], 0.0)
+            barycentrics[chunk, 1] = where(found, v[rows, closest], 0.0)
+        return (distances, indices, barycentrics)
+    
+    def is_occluded(self, point1, point2):
+        """Returns True, if any triangle intersects the segment from point1 to
+        point2. Unlike get_closest_intersection, the search stops at the first
+        block of triangles that contains a blocker.
+        """
+        return bool(self.get_occlusions(point1, point2)[0])
+    
+    def get_occlusions(self, points1, points2):
+        """Tests a packet of segments points1[i] to points2[i] for blocking
+        triangles. The triangles are tested in blocks of `occlusion_block_size`
+        and segments, that are already known to be blocked, are not tested
+        against further blocks.
         
+        :Parameters:
+            points1 : array
+                a (R, 3) array of segment starts or a single start shared by
+                all segments
+            points2 : array
+                a (R, 3) array of segment ends or a single end shared by all
+                segments
+        
+        :return: a (R, ) boolean array
+        """
+        points1 = asarray(points1, dtype=float)
+        points2 = asarray(points2, dtype=float)
+        directions = (points2 - points1).reshape((-1, 3))
+        origins = points1 + zeros(directions.shape)
+        directions = directions + zeros(origins.shape)
+        occluded = zeros(len(directions), dtype=bool)
+        if not len(self):
+            return occluded
+        
+        block_size = min(self.occlusion_block_size, len(self))
+        chunk_size = max(1, self.max_chunk_elements // block_size)
+        for start in xrange(0, len(directions), chunk_size):
+            pending = arange(start, min(start + chunk_size, len(directions)))
+            for block_start in xrange(0, len(self), block_size):
+                hits, t, u, v = self._intersect_packet(origins[pending], directions[pending],
+                                                       slice(block_start, block_start + block_size))
+                blocked = (hits & (t <= 1)).any(1)
+                occluded[pending[blocked]] = True
+                pending = pending[~blocked]
+                if not len(pending):
+                    break
+        return occluded
+    
+    def _intersect_packet(self, origins, directions, triangles):
+        """Intersects the rays origins[i] + t * directions[i] with the
+        triangles selected by the given slice using the Moeller-Trumbore test.
+        
+        :return: a (hits, t, u, v) tuple of (R, N) arrays
+        """
+        return get_ray_triangle_hits(origins[:, newaxis], directions[:, newaxis],
+                                     self.v0[triangles], self.edges1[triangles], self.edges2[triangles])
+    
+    def transformed(self, transformation):
+        """Returns a new TriangleArray with all corners transformed by the
+        given 4x4 matrix, computed as one matrix product like
+        TriangleList.transformed. Instances that are traced under a changing
+        matrix use TriangleArrayInstance instead.
+        """
+        new_vertices = transform_points(self.get_vertices(), transformation).reshape((-1, 3, 3))
+        return self.__class__(new_vertices[:, 0], new_vertices[:, 1], new_vertices[:, 2])
+
+class TriangleAccelerator(object):
+    """Base class of the acceleration structures over the TriangleArray
+    `triangles`. Subclasses implement get_closest_hits and get_occlusions;
+    the other queries of TriangleArray are derived from them, so an
+    accelerator can be traced by the Raytracer directly or placed into the
+    world by a TriangleArrayInstance.
+    """
+    triangles = None
+    # the seconds it took to build the structure
+    build_time = 0.0
+    
+    def __len__(self):
+        return len(self.triangles)
+    
+    def get_bounding_box(self):
+        return self.triangles.get_bounding_box()
+    
+    def get_vertex_normals(self, weighting='uniform'):
+        return self.triangles.get_vertex_normals(weighting)
+    
+    def get_vertex_normal_map(self, weighting='uniform'):
+        return self.triangles.get_vertex_normal_map(weighting)
+    
+    def get_interpolated_normal(self, index, u, v, vertex_normals):
+        return self.triangles.get_interpolated_normal(index, u, v, vertex_normals)
+    
+    def get_closest_hit(self, origin, direction):
+        """Returns an (index, t, u, v) tuple for the closest hit of the ray
+        origin + t * direction (t >= 0) or None like
+        TriangleArray.get_closest_hit.
+        """
+        distances, indices, barycentrics = self.get_closest_hits(origin, direction)
+        if indices[0] < 0:
+            return None
+        return (indices[0], distances[0], barycentrics[0, 0], barycentrics[0, 1])
+    
+    def get_closest_intersection(self, point1, point2, vertex_normals):
+        """Returns a (triangle, point, normal) tuple for the closest hit of
+        the ray from point1 through point2 or None like
+        TriangleArray.get_closest_intersection.
+        """
+        direction = point2 - point1
+        hit = self.get_closest_hit(point1, direction)
+        if hit is None:
+            return None
+        index, t, u, v = hit
+        return (self.triangles[index], point1 + t * direction, self.get_interpolated_normal(index, u, v, vertex_normals))
+    
+    def get_closest_hits(self, origins, directions):
+        raise NotImplementedError()
+    
+    def is_occluded(self, point1, point2):
+        """Returns True, if any triangle intersects the segment from point1 to
+        point2.
+        """
+        return bool(self.get_occlusions(point1, point2)[0])
+    
+    def get_occlusions(self, points1, points2):
+        raise NotImplementedError()
+
+class TriangleArrayInstance(object):
+    """A TriangleArray placed into the world by a 4x4 matrix. The triangles
+    stay in object space; the queries transform the rays by the inverse
+    matrix and the hits back into world space. So changing the matrix never
+    rebuilds any triangle data, and several instances can share one
+    TriangleArray. The queries take and return world space points like the
+    ones of TriangleArray, the vertex normals however are the ones of the
+    object space triangles.
+    """
+    def __init__(self, triangles, transformation):
+        """
+        :Parameters:
+            triangles : TriangleArray or TriangleAccelerator
+                the triangles in object space
+            transformation : array
+                the 4x4 matrix mapping object space to world space
+        """
+        self.triangles = triangles
+        self.transformation = asarray(transformation, dtype=float)
+        self.inverse_transformation = inv(self.transformation)
+        # normals are transformed by the inverse transpose
+        self.normal_transformation = self.inverse_transformation[0:3, 0:3].transpose()
+    
+    def __len__(self):
+        return len(self.triangles)
+    
+    def to_object_space(self, points):
+        return transform_points(asarray(points, dtype=float).reshape((-1, 3)), self.inverse_transformation)
+    
+    def to_world_space(self, points):
+        return transform_points(asarray(points, dtype=float).reshape((-1, 3)), self.transformation)
+    
+    def get_vertex_normals(self, weighting='uniform'):
+        return self.triangles.get_vertex_normals(weighting)
+    
+    def get_vertex_normal_map(self, weighting='uniform'):
+        return self.triangles.get_vertex_normal_map(weighting)
+    
+    def get_bounding_box(self):
+        bounding_box = self.triangles.get_bounding_box()
+        if bounding_box is None:
+            return None
+        lower, upper = bounding_box
+        corners = self.to_world_space([[x, y, z] for x in (lower[0], upper[0]) for y in (lower[1], upper[1]) for z in (lower[2], upper[2])])
+        return (corners.min(0), corners.max(0))
+    
+    def get_interpolated_normal(self, index, u, v, vertex_normals):
+        normal = dot(self.normal_transformation, self.triangles.get_interpolated_normal(index, u, v, vertex_normals))
+        return normal / norm(normal)
+    
+    def get_closest_intersection(self, point1, point2, vertex_normals):
+        object_point1, object_point2 = self.to_object_space([point1, point2])
+        intersection = self.triangles.get_closest_intersection(object_point1, object_point2, vertex_normals)
+        if intersection is None:
+            return None
+        triangle, point, normal = intersection
+        normal = dot(self.normal_transformation, normal)
+        return (Triangle(list(self.to_world_space(triangle.vertices))), self.to_world_space(point)[0], normal / norm(normal))
+    
+    def get_closest_hits(self, origins, directions):
+        directions = asarray(directions, dtype=float).reshape((-1, 3))
+        origins = asarray(origins, dtype=float) + zeros(directions.shape)
+        # the hit parameters t are the same in both spaces
+        return self.triangles.get_closest_hits(self.to_object_space(origins),
+                                               dot(directions, self.inverse_transformation[0:3, 0:3].transpose()))
+    
+    def is_occluded(self, point1, point2):
+        return bool(self.get_occlusions(point1, point2)[0])
+    
+    def get_occlusions(self, points1, points2):
+        points1 = asarray(points1, dtype=float)
+        points2 = asarray(points2, dtype=float)
+        shape = (points1 + points2).shape
+        return self.triangles.get_occlusions(self.to_object_space(points1 + zeros(shape)),
+                                             self.to_object_space(points2 + zeros(shape)))
+
+def get_ray_triangle_hits(origins, directions, v0, edges1, edges2):
+    """Intersects the rays origins + t * directions with the triangles given
+    by their first corners and edges using the Moeller-Trumbore test. All
+    arguments are (..., 3) arrays, that are broadcast against each other.
+    
+    :return: a (hits, t, u, v) tuple of arrays in the broadcast shape, where
+        t is inf for misses and u and v are the barycentric weights of the
+        second and third corner
+    """
+    pvecs = cross(directions, edges2)
+    determinants = einsum('...j,...j->...', edges1, pvecs)
+    with errstate(divide='ignore', invalid='ignore'):
+        inverse_determinants = 1.0 / determinants
+        tvecs = origins - v0
+        u = einsum('...j,...j->...', tvecs, pvecs) * inverse_determinants
+        qvecs = cross(tvecs, edges1)
+        v = einsum('...j,...j->...', directions, qvecs) * inverse_determinants
+        t = einsum('...j,...j->...', edges2, qvecs) * inverse_determinants
+        hits = (determinants != 0) & (u > 0) & (v > 0) & (u + v <= 1) & (t >= 0)
+    # rays parallel to a triangle give nan, that would not compare as miss
+    return (hits, where(hits, t, inf), u, v)
+
+def get_ray_triangle_hit(origin, direction, v0, edge1, edge2):
+    """Intersects one ray with one triangle like get_ray_triangle_hits, but
+    on sequences of three Python numbers, which is faster for single tests.
+    
+    :return: a (t, u, v) tuple or None
+    """
+    pvec = (direction[1] * edge2[2] - direction[2] * edge2[1],
+            direction[2] * edge2[0] - direction[0] * edge2[2],
+            direction[0] * edge2[1] - direction[1] * edge2[0])
+    determinant = edge1[0] * pvec[0] + edge1[1] * pvec[1] + edge1[2] * pvec[2]
+    if determinant == 0:
+        return None
+    inverse_determinant = 1.0 / determinant
+    tvec = (origin[0] - v0[0], origin[1] - v0[1], origin[2] - v0[2])
+    u = (tvec[0] * pvec[0] + tvec[1] * pvec[1] + tvec[2] * pvec[2]) * inverse_determinant
+    if not 0 < u <= 1:
+        return None
+    qvec = (tvec[1] * edge1[2] - tvec[2] * edge1[1],
+            tvec[2] * edge1[0] - tvec[0] * edge1[2],
+            tvec[0] * edge1[1] - tvec[1] * edge1[0])
+    v = (direction[0] * qvec[0] + direction[1] * qvec[1] + direction[2] * qvec[2]) * inverse_determinant
+    if not (v > 0 and u + v <= 1):
+        return None
+    t = (edge2[0] * qvec[0] + edge2[1] * qvec[1] + edge2[2] * qvec[2]) * inverse_determinant
+    if not t >= 0:
+        return None
+    return (t, u, v)
+
+def transform_points(points, transformation):
+    """Returns the (N, 3) points transformed by the 4x4 matrix, computed as a
+    single (N, 4) x (4, 4) matrix product.
+    """
+    homogeneous = hstack((points, ones((len(points), 1))))
+    return dot(homogeneous, asarray(transformation, dtype=float).transpose())[:, 0:3]
+
+def unique_rows(rows):
+    """Returns the distinct rows of a 2d array."""
+    return index_rows(rows)[0]
+
+def index_rows(rows):
+    """Returns the distinct rows of a 2d array in the order of their first
+    occurrence and for every row the index of its distinct row.
+    """
+    if not len(rows):
+        return (rows, zeros(0, dtype=int))
+    # adding 0.0 turns -0.0 into 0.0, so both compare equal byte-wise
+    rows = ascontiguousarray(rows) + 0.0
+    row_view = rows.view(dtype((void, rows.dtype.itemsize * rows.shape[1]))).ravel()
+    unused, indices, inverse = unique(row_view, return_index=True, return_inverse=True)
+    order = argsort(indices)
+    ranks = empty(len(order), dtype=int)
+    ranks[order] = arange(len(order))
+    return (rows[indices[order]], ranks[inverse])
+
+def get_vertex_normals(vertices, faces, weighting='uniform'):
+    """Returns a (V, 3) array holding the weighted mean of the normals of the
+    adjacent faces for every vertex. The face normals are scattered onto
+    their corners in one pass over all faces.
+    
+    :Parameters:
+        vertices : array
+            a (V, 3) array of vertex coordinates
+        faces : array
+            a (N, 3) integer array of vertex indices
+        weighting : string
+            'uniform' weights every adjacent face equally, 'area' by its
+            area and 'angle' by its interior angle at the vertex
+    """
+    normal_sums, weight_sums = _scatter_vertex_normals(len(vertices), faces, vertices[faces], weighting)
+    return normal_sums / where(weight_sums > 0, weight_sums, 1)[:, newaxis]
+
+def _scatter_vertex_normals(vertex_count, faces, corners, weighting):
+    """Returns the (vertex_count, 3) sums of the weighted normals of the
+    adjacent faces and the (vertex_count,) sums of their weights. The (N, 3)
+    faces index the vertices and the (N, 3, 3) corners hold their coordinates.
+    """
+    normals = cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    double_areas = norm(normals, axis=1)
+    normals = normals / double_areas[:, newaxis]
+    if weighting == 'uniform':
+        weights = ones(faces.shape)
+    elif weighting == 'area':
+        weights = double_areas[:, newaxis].repeat(3, axis=1)
+    elif weighting == 'angle':
+        weights = empty(faces.shape)
+        for corner in range(3):
+            edges1 = corners[:, (corner + 1) % 3] - corners[:, corner]
+            edges2 = corners[:, (corner + 2) % 3] - corners[:, corner]
+            weights[:, corner] = arctan2(norm(cross(edges1, edges2), axis=1), einsum('ij,ij->i', edges1, edges2))
+    else:
+        raise ValueError(u"unknown normal weighting '%s'" % weighting)
+    
+    vertex_indices = faces.ravel()
+    weights = weights.ravel()
+    weighted_normals = normals.repeat(3, axis=0) * weights[:, newaxis]
+    weight_sums = bincount(vertex_indices, weights=weights, minlength=vertex_count)
+    normal_sums = stack([bincount(vertex_indices, weights=weighted_normals[:, axis], minlength=vertex_count) for axis in range(3)], axis=1)
+    return (normal_sums, weight_sums)
+
+def get_texture_coordinates(vertices, projection='sphere'):
+    """Returns a (V, 2) array holding the texture coordinates of the (V, 3)
+    vertices.
+    
+    :Parameters:
+        vertices : array
+            the vertices to map
+        projection : string
+            'sphere' maps longitude and colatitude around the z axis,
+            'cylinder' maps longitude and height along the z axis and
+            'plane' maps x and y; heights and plane coordinates are scaled
+            to the extent of the vertices
+    """
+    x, y, z = vertices[:, 0], vertices[:, 1], vertices[:, 2]
+    if projection == 'sphere':
+        u = (pi + arctan2(y, x)) / (2 * pi)
+        v = arctan2(sqrt(x**2 + y**2), z) / pi
+    elif projection == 'cylinder':
+        u = (pi + arctan2(y, x)) / (2 * pi)
+        v = _scale_to_unit(z)
+    elif projection == 'plane':
+        u = _scale_to_unit(x)
+        v = _scale_to_unit(y)
+    else:
+        raise ValueError(u"unknown texture projection '%s'" % projection)
+    return column_stack((u, v))
+
+def _scale_to_unit(values):
+    if not len(values) or values.max() == values.min():
+        return values * 0.0
+    return (values - values.min()) / (values.max() - values.min())
+
+class IndexedTriangleMesh(object):
+    """A triangle mesh stored as a shared vertex array and an array of vertex
+    indices per face. Adjacency is given by the indices, so no vertices need
+    to be copied or hashed to find the triangles sharing them.
+    """
+    weightings = ('uniform', 'area', 'angle')
+    projections = ('sphere', 'cylinder', 'plane')
+    
+    def __init__(self, vertices, faces):
+        """
+        :Parameters:
+            vertices : array
+                a (V, 3) array of vertex coordinates
+            faces : array
+                a (N, 3) integer array of vertex indices
+        """
+        self.vertices = vertices
+        self.faces = faces
+        self._vertex_normals = {}
+        self._texture_coordinates = {}
+        self._bounding_box = None
+    
+    @classmethod
+    def from_corners(cls, corners):
+        """Creates a mesh from a (N, 3, 3) array holding the three corners of
+        each triangle. Corners with equal coordinates become one vertex.
+        """
+        vertices, indices = index_rows(asarray(corners, dtype=float).reshape((-1, 3)))
+        return cls(vertices, indices.reshape((-1, 3)))
+    
+    def geometry_changed(self):
+        """Drops the cached vertex normals, texture coordinates and bounding
+        box. Call this after modifying the vertices or faces in place.
+        """
+        self._vertex_normals = {}
+        self._texture_coordinates = {}
+        self._bounding_box = None
+    
+    def __len__(self):
+        return len(self.faces)
+    
+    def get_corners(self):
+        """Returns a (N, 3, 3) array holding the three vertices of each face."""
+        return self.vertices[self.faces]
+    
+    def get_face_normals(self):
+        """Returns a (N, 3) array of unit face normals."""
+        corners = self.get_corners()
+        normals = cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+        return normals / norm(normals, axis=1)[:, newaxis]
+    
+    def get_vertex_normals(self, weighting='uniform'):
+        """Returns a (V, 3) array holding the weighted mean of the normals of
+        the adjacent faces for every vertex (see get_vertex_normals). The
+        result is cached until geometry_changed is called.
+        
+        :Parameters:
+            weighting : string
+                one of `weightings`
+        """
+        if weighting not in self._vertex_normals:
+            self._vertex_normals[weighting] = get_vertex_normals(self.vertices, self.faces, weighting)
+        return self._vertex_normals[weighting]
+    
+    def get_vertex_normal_map(self, weighting='uniform'):
+        """Returns the vertex normals as dictionary mapping vertex tuples to
+        normals like TriangleList.get_vertex_normal_map.
+        """
+        return dict(zip([tuple(vertex) for vertex in self.vertices.tolist()], self.get_vertex_normals(weighting)))
+    
+    def get_texture_coordinates(self, projection='sphere'):
+        """Returns a (V, 2) array holding the texture coordinates of every
+        vertex (see get_texture_coordinates). The result is cached until
+        geometry_changed is called.
+        
+        :Parameters:
+            projection : string
+                one of `projections`
+        """
+        if projection not in self._texture_coordinates:
+            self._texture_coordinates[projection] = get_texture_coordinates(self.vertices, projection)
+        return self._texture_coordinates[projection]
+    
+    def get_vertex_texture_map(self, projection='sphere'):
+        """Returns the texture coordinates as dictionary mapping vertex tuples
+        to (u, v) tuples like TriangleList.get_vertex_sphere_map.
+        """
+        return dict(zip([tuple(vertex) for vertex in self.vertices.tolist()],
+                        [tuple(uv) for uv in self.get_texture_coordinates(projection).tolist()]))
+    
+    def get_bounding_box(self):
+        """Returns the bounding box of all vertices referenced by a face. The
+        result is cached until geometry_changed is called.
+        
+        :return: a (minimum, maximum) pair of vertices or None if there are
+            no faces
+        """
+        if not len(self.faces):
+            return None
+        if self._bounding_box is None:
+            used = zeros(len(self.vertices), dtype=bool)
+            used[self.faces.ravel()] = True
+            used_vertices = self.vertices[used]
+            self._bounding_box = (used_vertices.min(0), used_vertices.max(0))
+        return self._bounding_box
+    
+    def get_triangle_array(self):
+        """Returns the triangles of the mesh as TriangleArray, that keeps the
+        faces of this mesh for indexing the vertex normals.
+        """
+        return TriangleArray(self.vertices[self.faces[:, 0]], self.vertices[self.faces[:, 1]], self.vertices[self.faces[:, 2]], self)
+    
+    def get_triangles(self):
+        """Returns the mesh as a TriangleList. Every Triangle holds a copy of
+        its three vertices.
+        """
+        vertex_rows = list(self.vertices)
+        return TriangleList([Triangle([vertex_rows[v1], vertex_rows[v2], vertex_rows[v3]]) for v1, v2, v3 in self.faces])
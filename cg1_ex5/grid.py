@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""
+This is a uniform voxel grid over the triangles of a TriangleArray. Every
+triangle is binned into the cells overlapped by its bounding box. The bins
+are kept in flat arrays like a counting sort: the triangles of cell i are
+cell_triangles[cell_start[i]:cell_start[i + 1]], where cells are numbered
+x + resolution[0] * (y + resolution[1] * z).
+
+Rays walk the cells they pass with a 3D-DDA, so the triangles of far cells
+are never tested once a hit has been found. This suits dense meshes of
+evenly sized triangles like scans. The queries are the ones of
+geometry.TriangleAccelerator.
+
+The comments in this file are written in the reStructured text format and adhere
+to the commenting style used by epydoc.
+"""
+
+import logging
+import time
+
+from numpy import arange, argmin, argsort, asarray, bincount, ceil, clip, concatenate, cumsum, empty, \
+    flatnonzero, floor, inf, lexsort, maximum, minimum, ones, where, zeros
+
+from geometry import TriangleAccelerator, TriangleArray, get_ray_triangle_hits
+
+class TriangleGrid(TriangleAccelerator):
+    """A uniform grid over a TriangleArray."""
+    # the number of cells per triangle
+    density = 2.0
+    # the maximum number of cells along an axis
+    max_resolution = 128
+    # queries with fewer rays walk the grid ray by ray
+    packet_threshold = 8
+    # the number of rays walked together
+    packet_size = 4096
+
+    def __init__(self, triangles, resolution=None):
+        """
+        :Parameters:
+          triangles : TriangleArray
+            the triangles to bin (other triangle lists are converted)
+
+        :Keywords:
+          resolution : sequence
+            the number of cells along each axis; by default it is chosen, so
+            the grid has about `density` cells per triangle with cubic cells
+        """
+        self._log = logging.getLogger('TriangleGrid')
+        if not isinstance(triangles, TriangleArray):
+            triangles = TriangleArray.from_triangles(triangles)
+        self.triangles = triangles
+        start = time.time()
+        self._build(resolution)
+        self.build_time = time.time() - start
+        self._cell_list = None
+        self._log.info(u"Built a %dx%dx%d grid with %d entries over %d triangles in %.2f s." % (tuple(self.resolution) + (len(self.cell_triangles), len(triangles), self.build_time)))
+
+    def _get_resolution(self, extents):
+        """Returns the resolution with about `density` cubic cells per
+        triangle. Flat meshes get a single cell along their flat axis.
+        """
+        axes = extents > 1e-9 * extents.max()
+        resolution = ones(3, dtype=int)
+        if not len(self.triangles) or not axes.any():
+            return resolution
+        cell_size = (extents[axes].prod() / (self.density * len(self.triangles))) ** (1.0 / axes.sum())
+        resolution[axes] = clip(ceil(extents[axes] / cell_size), 1, self.max_resolution)
+        return resolution
+
+    def _build(self, resolution):
+        """Builds the cell arrays. The number of entries per cell is counted
+        first, its prefix sums give the start of every cell and the entries
+        are then placed in cell order.
+        """
+        if len(self.triangles):
+            self.lower, self.upper = self.triangles.get_bounding_box()
+        else:
+            self.lower = self.upper = zeros(3)
+        extents = self.upper - self.lower
+        if resolution is None:
+            resolution = self._get_resolution(extents)
+        self.resolution = asarray(resolution, dtype=int)
+        # the grid is padded, so hits on the faces of the bounding box are
+        # found before the rays leave the grid
+        padding = 1e-7 * max(extents.max(), 1e-300)
+        self.lower = self.lower - padding
+        self.upper = self.upper + padding
+        self.cell_size = (self.upper - self.lower) / self.resolution
+        self.inverse_cell_size = 1.0 / self.cell_size
+        cell_count = self.resolution.prod()
+
+        # the cell ranges overlapped by the bounds of the triangles, which are
+        # padded, so hits on cell borders are found in both cells
+        triangle_lower, triangle_upper = self.triangles.get_triangle_bounds()
+        padding = 1e-7 * self.cell_size
+        lower_cells = self._get_cells(triangle_lower - padding)
+        upper_cells = self._get_cells(triangle_upper + padding)
+        spans = upper_cells - lower_cells + 1
+        counts = spans.prod(1)
+
+        # one entry per overlapped cell of every triangle
+        entry_triangles = arange(len(self.triangles)).repeat(counts)
+        offsets = arange(counts.sum()) - (cumsum(counts) - counts).repeat(counts)
+        spans = spans.repeat(counts, axis=0)
+        cells = lower_cells.repeat(counts, axis=0)
+        cells[:, 0] += offsets % spans[:, 0]
+        cells[:, 1] += (offsets // spans[:, 0]) % spans[:, 1]
+        cells[:, 2] += offsets // (spans[:, 0] * spans[:, 1])
+        entry_cells = self._get_cell_indices(cells)
+
+        self.cell_start = concatenate(([0], cumsum(bincount(entry_cells, minlength=cell_count))))
+        self.cell_triangles = entry_triangles[argsort(entry_cells, kind='mergesort')]
+
+    def _get_cells(self, points):
+        """Returns the (x, y, z) cells containing the points, clipped to the
+        grid.
+        """
+        return clip(floor((points - self.lower) * self.inverse_cell_size).astype(int), 0, self.resolution - 1)
+
+    def _get_cell_indices(self, cells):
+        return cells[:, 0] + self.resolution[0] * (cells[:, 1] + self.resolution[1] * cells[:, 2])
+
+    def _setup_walk(self, origins, directions, t_limits):
+        """Clips the rays to the grid and returns the state of the 3D-DDA at
+        the entry point of every ray.
+
+        :return: a (rays, cells, steps, next_t, delta_t, t_ends) tuple of the
+            rays, that enter the grid before t_limits, their first cells, the
+            cell steps, the ray parameters of the next cell border along
+            each axis, the ray parameter steps between cell borders and the
+            ray parameters, after which the walks end
+        """
+        inverse_directions = 1.0 / where(directions == 0, 1e-300, directions)
+        t1 = (self.lower - origins) * inverse_directions
+        t2 = (self.upper - origins) * inverse_directions
+        t_entries = maximum(minimum(t1, t2).max(1), 0)
+        t_ends = minimum(maximum(t1, t2).min(1), t_limits)
+        rays = flatnonzero(t_entries <= t_ends)
+        origins, directions, inverse_directions = origins[rays], directions[rays], inverse_directions[rays]
+        t_entries, t_ends = t_entries[rays], t_ends[rays]
+
+        cells = self._get_cells(origins + t_entries[:, None] * directions)
+        steps = where(directions > 0, 1, where(directions < 0, -1, 0))
+        borders = self.lower + (cells + (steps > 0)) * self.cell_size
+        next_t = where(steps != 0, (borders - origins) * inverse_directions, inf)
+        delta_t = where(steps != 0, abs(self.cell_size * inverse_directions), inf)
+        return (rays, cells, steps, next_t, delta_t, t_ends)
+
+    def get_closest_hits(self, origins, directions):
+        """Intersects a packet of rays origins[i] + t * directions[i] (t >= 0)
+        with the triangles like TriangleArray.get_closest_hits. Every ray
+        walks the grid, until a hit is found in its current cell.
+        """
+        directions = asarray(directions, dtype=float).reshape((-1, 3))
+        origins = asarray(origins, dtype=float) + zeros(directions.shape)
+        distances = empty(len(directions))
+        distances.fill(inf)
+        indices = empty(len(directions), dtype=int)
+        indices.fill(-1)
+        barycentrics = zeros((len(directions), 2))
+        if not len(self.triangles):
+            return (distances, indices, barycentrics)
+
+        if len(directions) < self.packet_threshold:
+            for ray in range(len(directions)):
+                hit = self._walk(origins[ray], directions[ray], False)
+                if hit is not None:
+                    indices[ray], distances[ray], barycentrics[ray, 0], barycentrics[ray, 1] = hit
+            return (distances, indices, barycentrics)
+
+        for start in xrange(0, len(directions), self.packet_size):
+            chunk = slice(start, start + self.packet_size)
+            rays, cells, steps, next_t, delta_t, t_ends = self._setup_walk(origins[chunk], directions[chunk], inf)
+            rays += start
+            while len(rays):
+                cell_exits = next_t.min(1)
+                pair_rays, pair_triangles, pair_exits = self._get_cell_pairs(rays, cells, cell_exits)
+                hits, t, u, v = get_ray_triangle_hits(origins[pair_rays], directions[pair_rays], self.triangles.v0[pair_triangles],
+                                                      self.triangles.edges1[pair_triangles], self.triangles.edges2[pair_triangles])
+                # only hits inside the current cell are final
+                inside = flatnonzero(hits & (t <= pair_exits))
+                if len(inside):
+                    # keep the closest hit per ray, ties go to the first triangle
+                    inside = inside[lexsort((pair_triangles[inside], t[inside], pair_rays[inside]))]
+                    first = concatenate(([True], pair_rays[inside][1:] != pair_rays[inside][:-1]))
+                    closest = inside[first]
+                    hit_rays = pair_rays[closest]
+                    distances[hit_rays] = t[closest]
+                    indices[hit_rays] = pair_triangles[closest]
+                    barycentrics[hit_rays, 0] = u[closest]
+                    barycentrics[hit_rays, 1] = v[closest]
+
+                walking = self._step(cells, steps, next_t, delta_t, t_ends, indices[rays] < 0)
+                rays, cells, steps, next_t, delta_t, t_ends = rays[walking], cells[walking], steps[walking], next_t[walking], delta_t[walking], t_ends[walking]
+        return (distances, indices, barycentrics)
+
+    def get_occlusions(self, points1, points2):
+        """Tests a packet of segments points1[i] to points2[i] for blocking
+        triangles like TriangleArray.get_occlusions. A segment stops walking
+        the grid as soon as a blocker is found.
+        """
+        points1 = asarray(points1, dtype=float)
+        points2 = asarray(points2, dtype=float)
+        directions = (points2 - points1).reshape((-1, 3))
+        origins = points1 + zeros(directions.shape)
+        directions = directions + zeros(origins.shape)
+        occluded = zeros(len(directions), dtype=bool)
+        if not len(self.triangles):
+            return occluded
+
+        if len(directions) < self.packet_threshold:
+            for ray in range(len(directions)):
+                occluded[ray] = self._walk(origins[ray], directions[ray], True) is not None
+            return occluded
+
+        for start in xrange(0, len(directions), self.packet_size):
+            chunk = slice(start, start + self.packet_size)
+            rays, cells, steps, next_t, delta_t, t_ends = self._setup_walk(origins[chunk], directions[chunk], 1.0)
+            rays += start
+            while len(rays):
+                pair_rays, pair_triangles, pair_exits = self._get_cell_pairs(rays, cells, next_t.min(1))
+                hits, t, u, v = get_ray_triangle_hits(origins[pair_rays], directions[pair_rays], self.triangles.v0[pair_triangles],
+                                                      self.triangles.edges1[pair_triangles], self.triangles.edges2[pair_triangles])
+                occluded[pair_rays[hits & (t <= 1)]] = True
+
+                walking = self._step(cells, steps, next_t, delta_t, t_ends, ~occluded[rays])
+                rays, cells, steps, next_t, delta_t, t_ends = rays[walking], cells[walking], steps[walking], next_t[walking], delta_t[walking], t_ends[walking]
+        return occluded
+
+    def _get_cell_pairs(self, rays, cells, cell_exits):
+        """Returns the (ray, triangle, cell exit) triples of all triangles in
+        the current cells of the rays.
+        """
+        cell_indices = self._get_cell_indices(cells)
+        starts = self.cell_start[cell_indices]
+        counts = self.cell_start[cell_indices + 1] - starts
+        offsets = arange(counts.sum()) - (cumsum(counts) - counts).repeat(counts)
+        return (rays.repeat(counts), self.cell_triangles[starts.repeat(counts) + offsets], cell_exits.repeat(counts))
+
+    def _step(self, cells, steps, next_t, delta_t, t_ends, walking):
+        """Moves the rays, that are still walking, into their next cells in
+        place.
+
+        :return: a boolean array telling which rays are still inside the grid
+            and before the ends of their walks
+        """
+        rows = arange(len(cells))
+        axes = next_t.argmin(1)
+        walking = walking & (next_t[rows, axes] <= t_ends)
+        cells[rows, axes] += steps[rows, axes]
+        next_t[rows, axes] += delta_t[rows, axes]
+        return walking & (cells >= 0).all(1) & (cells < self.resolution).all(1)
+
+    def _get_cell_list(self):
+        """Returns the cell starts as list of Python numbers, that are faster
+        to access one by one.
+        """
+        if self._cell_list is None:
+            self._cell_list = self.cell_start.tolist()
+        return self._cell_list
+
+    def _walk(self, origin, direction, any_hit):
+        """Walks the grid with a single ray.
+
+        :Parameters:
+          origin : array
+            the origin of the ray
+          direction : array
+            the direction of the ray
+          any_hit : boolean
+            whether to return the first hit with t <= 1 instead of the closest
+            hit
+
+        :return: an (index, t, u, v) tuple or None
+        """
+        rays, cells, steps, next_t, delta_t, t_ends = self._setup_walk(origin[None], direction[None], any_hit and 1.0 or inf)
+        if not len(rays):
+            return None
+        cell, step, next_t, delta_t = cells[0].tolist(), steps[0].tolist(), next_t[0].tolist(), delta_t[0].tolist()
+        t_end = t_ends[0]
+        resolution = self.resolution.tolist()
+        cell_start = self._get_cell_list()
+        while True:
+            cell_index = cell[0] + resolution[0] * (cell[1] + resolution[1] * cell[2])
+            start, end = cell_start[cell_index], cell_start[cell_index + 1]
+            cell_exit = min(next_t)
+            if end > start:
+                triangles = self.cell_triangles[start:end]
+                hits, t, u, v = get_ray_triangle_hits(origin, direction, self.triangles.v0[triangles],
+                                                      self.triangles.edges1[triangles], self.triangles.edges2[triangles])
+                t = where(hits, t, inf)
+                index = argmin(t)
+                if hits[index] and t[index] <= (any_hit and 1.0 or cell_exit):
+                    return (triangles[index], t[index], u[index], v[index])
+            axis = next_t.index(cell_exit)
+            if cell_exit > t_end:
+                return None
+            cell[axis] += step[axis]
+            if not 0 <= cell[axis] < resolution[axis]:
+                return None
+            next_t[axis] += delta_t[axis]
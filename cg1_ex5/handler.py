@@ -16,7 +16,7 @@ from OpenGL.GLUT import *
 
 import Image
 
-from writer import capture_screen
+from writer import capture_screen, FrameRecorder
 
 class BaseHandler(object):
     def __init__(self, application, scene):
@@ -115,6 +115,7 @@ class DefaultHandler(object):
             's'     : self._handle_screenshot, 
             'v'     : self._handle_toggle_mesh_visibility, 
             'a'     : self._handle_area_raytrace, 
+            'b'     : self._handle_toggle_recording, 
             }
         
         self._mouse_position        = [0, 0]
@@ -208,11 +209,22 @@ class DefaultHandler(object):
         self._application._current_scene.raytrace()
     
     def _handle_screenshot(self, *args, **kwargs):
-        image, filename = capture_screen()
-        self._log.info(u"Saved screenshot as '%s'." % filename)
+        image, filename = capture_screen(writer=self._application._image_writer)
+        self._log.info(u"Saving screenshot as '%s'." % filename)
+    
+    def _handle_toggle_recording(self, *args, **kwargs):
+        if self._application._frame_recorder:
+            self._log.info(u"Stopped recording after %d frames." % self._application._frame_recorder.frame_count)
+            self._application._frame_recorder = None
+        else:
+            self._application._frame_recorder = FrameRecorder(self._application._image_writer)
+            self._log.info(u"Recording every frame...")
     
     def _handle_toggle_mesh_visibility(self, *args, **kwargs):
-        self._application._current_scene.mesh.visible = not self._application._current_scene.mesh.visible
+        mesh = self._application._current_scene.mesh
+        if mesh is None:
+            return
+        mesh.visible = not mesh.visible
     
     def get_menu_id(self, menu_entry, args=[], kwargs={}):
         menu_id = hash(menu_entry) + hash(self)
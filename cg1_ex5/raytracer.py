@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+This is the raytracer of exercise 5. It does not depend on OpenGL, so it can
+be used from the interactive scene as well as for offline rendering without
+a window.
+
+The comments in this file are written in the reStructured text format and adhere
+to the commenting style used by epydoc.
+"""
+
+import logging
+
+from numpy import array, asarray, cross, dot, eye, inner, newaxis, ones, radians, tan, zeros
+from numpy.linalg import inv, norm
+
+from bvh import TriangleBvh
+from geometry import TriangleAccelerator, TriangleArray, TriangleArrayInstance
+from grid import TriangleGrid
+
+# the acceleration structures by the names used in the configuration files
+accelerators = {'none': None, 'bvh': TriangleBvh, 'grid': TriangleGrid}
+
+def get_accelerator(triangles, name):
+    """Returns the triangles in the acceleration structure with the given
+    name (see accelerators), so the structures can be chosen per scene.
+    With 'none' the TriangleArray is returned and every ray is tested
+    against all triangles.
+    """
+    if name not in accelerators:
+        raise ValueError(u"Unknown accelerator '%s', use one of %s." % (name, ', '.join(sorted(accelerators))))
+    if not isinstance(triangles, TriangleArray):
+        triangles = TriangleArray.from_triangles(triangles)
+    if accelerators[name] is None:
+        return triangles
+    return accelerators[name](triangles)
+
+def look_at(eye_position, center, up):
+    """Returns the viewing matrix set up by gluLookAt."""
+    eye_position, center, up = array(eye_position, dtype=float), array(center, dtype=float), array(up, dtype=float)
+    forward = center - eye_position
+    forward = forward / norm(forward)
+    side = cross(forward, up)
+    side = side / norm(side)
+    up = cross(side, forward)
+
+    matrix = eye(4)
+    matrix[0, 0:3] = side
+    matrix[1, 0:3] = up
+    matrix[2, 0:3] = -forward
+    matrix[0:3, 3] = -dot(matrix[0:3, 0:3], eye_position)
+    return matrix
+
+def perspective(fovy, aspect, near, far):
+    """Returns the projection matrix set up by gluPerspective."""
+    f = 1.0 / tan(radians(fovy) / 2.0)
+    matrix = array([[f / aspect, 0.0, 0.0, 0.0],
+                    [0.0, f, 0.0, 0.0],
+                    [0.0, 0.0, (far + near) / (near - far), 2.0 * far * near / (near - far)],
+                    [0.0, 0.0, -1.0, 0.0]])
+    return matrix
+
+def unproject(window_point, modelview, projection, viewport):
+    """Maps window coordinates back to object coordinates like gluUnProject.
+
+    :Parameters:
+      window_point : array
+        the window x, y and depth of one point, or a (..., 3) array of
+        such points
+      modelview : array
+        the 4x4 modelview matrix
+      projection : array
+        the 4x4 projection matrix
+      viewport : sequence
+        the viewport x, y, width and height
+    """
+    window_points = asarray(window_point, dtype=float)
+    device_points = ones(window_points.shape[:-1] + (4, ))
+    device_points[..., 0] = 2.0 * (window_points[..., 0] - viewport[0]) / viewport[2] - 1.0
+    device_points[..., 1] = 2.0 * (window_points[..., 1] - viewport[1]) / viewport[3] - 1.0
+    device_points[..., 2] = 2.0 * window_points[..., 2] - 1.0
+    points = dot(device_points, inv(dot(projection, modelview)).transpose())
+    return points[..., 0:3] / points[..., 3, newaxis]
+
+class Light(object):
+    def __init__(self, position, ambient, diffuse, specular):
+        self.position   = array(position[0:3], dtype=float)
+        self.ambient    = array(ambient, dtype=float)
+        self.diffuse    = array(diffuse, dtype=float)
+        self.specular   = array(specular, dtype=float)
+
+class Material(object):
+    def __init__(self, ambient, diffuse, specular):
+        self.ambient    = array(ambient, dtype=float)
+        self.diffuse    = array(diffuse, dtype=float)
+        self.specular   = array(specular, dtype=float)
+
+class Raytracer(object):
+    """Traces rays against a triangle list or a TriangleAccelerator, that is either
+    already transformed into the coordinate system of the rays and lights or
+    placed there by a TriangleArrayInstance.
+    """
+    def __init__(self, triangles, lights, material, max_recursion=2):
+        """
+        :Parameters:
+          triangles : TriangleArray, TriangleAccelerator or TriangleArrayInstance
+            the triangles to trace against (other triangle lists are
+            converted)
+          lights : sequence
+            the Light objects illuminating the triangles
+          material : Material
+            the material of the triangles
+
+        :Keywords:
+          max_recursion : int
+            the maximum number of reflections plus one
+        """
+        if not isinstance(triangles, (TriangleArray, TriangleAccelerator, TriangleArrayInstance)):
+            triangles = TriangleArray.from_triangles(triangles)
+        self.triangles      = triangles
+        self.vertex_normals = triangles.get_vertex_normals()
+        self.lights         = lights
+        self.material       = material
+        self.max_recursion  = max_recursion
+        self._log = logging.getLogger('Raytracer')
+
+    def trace(self, ray_origin, ray_target):
+        """Traces the ray from ray_origin through ray_target.
+
+        :return: a (point, normal, color) tuple for the closest hit or None
+        """
+        intersection = self.triangles.get_closest_intersection(ray_origin, ray_target, self.vertex_normals)
+        if intersection:
+            intersection_triangle, intersection_point, intersection_normal = intersection
+            color = self.get_color(intersection_point, ray_origin, intersection_normal, 0)
+            return (intersection_point, intersection_normal, color)
+        return None
+
+    def trace_rays(self, ray_origins, ray_targets):
+        """Traces a packet of rays, each from ray_origins[i] through
+        ray_targets[i]. The closest hits of all rays are found in one
+        batched query.
+
+        :Parameters:
+          ray_origins : array
+            a (R, 3) array of ray origins or a single origin shared by all rays
+          ray_targets : array
+            a (R, 3) array of points the rays pass through
+
+        :return: a list holding a (point, normal, color) tuple or None for
+            each ray
+        """
+        ray_targets = asarray(ray_targets, dtype=float)
+        ray_origins = asarray(ray_origins, dtype=float) + zeros(ray_targets.shape)
+        directions = ray_targets - ray_origins
+        distances, indices, barycentrics = self.triangles.get_closest_hits(ray_origins, directions)
+        hit_rays = (indices >= 0).nonzero()[0]
+        intersection_points = ray_origins[hit_rays] + distances[hit_rays, newaxis] * directions[hit_rays]
+        # the shadow rays of all hits are tested in one batch per light
+        shadows = [self.get_shadows(intersection_points, light.position) for light in self.lights]
+        surface_points = [None] * len(indices)
+        for hit_index, ray_index in enumerate(hit_rays):
+            u, v = barycentrics[ray_index]
+            intersection_point = intersection_points[hit_index]
+            intersection_normal = self.triangles.get_interpolated_normal(indices[ray_index], u, v, self.vertex_normals)
+            color = self.get_color(intersection_point, ray_origins[ray_index], intersection_normal, 0,
+                                   [shadow[hit_index] for shadow in shadows])
+            surface_points[ray_index] = (intersection_point, intersection_normal, color)
+        return surface_points
+
+    def get_color(self, intersection_point, ray_origin, normal, current_recursion, shadows=None):
+        """Returns the color at the intersection point.
+
+        :Keywords:
+          shadows : sequence
+            whether the point is in the shadow of each light, if that is
+            already known (e.g. from a batched shadow query)
+        """
+        colors = array([0.0, 0.0, 0.0, 0.0])
+        black = array([0.0, 0.0, 0.0, 1.0])
+
+        for light_index, light in enumerate(self.lights):
+            light_direction         = light.position - intersection_point
+            light_direction         = light_direction / norm(light_direction)
+
+            if shadows is not None:
+                in_shadow = shadows[light_index]
+            else:
+                in_shadow = self.is_in_shadow(intersection_point, light.position)
+            if not in_shadow:
+                light_ambient       = light.ambient
+                light_diffuse       = light.diffuse
+                light_specular      = light.specular
+                material_ambient    = self.material.ambient
+                material_diffuse    = self.material.diffuse
+                material_specular   = self.material.specular
+            else:
+                light_ambient       = black
+                light_diffuse       = black
+                light_specular      = black
+                material_ambient    = black
+                material_diffuse    = black
+                material_specular   = black
+
+            incoming_direction = intersection_point - ray_origin
+            outgoing_direction = 2 * (normal * inner(normal, incoming_direction)) - incoming_direction
+
+            reflective = array([0.0, 0.0, 0.0, 0.0])
+            while current_recursion + 1 < self.max_recursion:
+                current_recursion += 1
+                new_intersection = self.triangles.get_closest_intersection(intersection_point, intersection_point + outgoing_direction, self.vertex_normals)
+                if new_intersection != None:
+                    reflective += self.get_color(new_intersection[1], intersection_point, new_intersection[2], current_recursion)
+
+            ambient     = light_ambient * material_ambient
+            diffuse     = light_diffuse * material_diffuse * inner(normal, light_direction)
+            specular    = light_specular * material_specular * reflective
+
+            colors += ambient + diffuse + specular
+
+        return colors
+
+    def is_in_shadow(self, intersection_point, light_position):
+        return self.triangles.is_occluded(intersection_point+0.1, light_position)
+
+    def get_shadows(self, intersection_points, light_position):
+        """Returns a boolean array, that tells which of the (R, 3)
+        intersection points are in the shadow of the light.
+        """
+        return self.triangles.get_occlusions(intersection_points+0.1, light_position)
@@ -1,38 +1,530 @@
 import logging
+import mmap
+import os
+import struct
+from itertools import islice
+from multiprocessing import Pool, cpu_count
+from threading import Event, Thread
 
-from numpy import array
+from numpy import asarray, clip, column_stack, concatenate, dtype, empty, flatnonzero, frombuffer, fromstring, int32, linspace, memmap, ndarray, searchsorted, uint8, unique, zeros
 
-from geometry import Triangle, TriangleList
+from geometry import IndexedTriangleMesh, Triangle, TriangleList
 
 class FileFormatException(Exception):
     pass
 
-class openOff(object):
+class MeshCache(object):
+    """A binary sidecar file holding the vertex and face arrays of a mesh file.
+
+    The cache is keyed by the absolute path, size and modification time of the
+    source file. Its layout is a fixed header followed by the vertex block
+    (little endian float64) and the face block (little endian int32), so both
+    blocks can be memory-mapped directly.
+    """
+    magic = "OFFC"
+    version = 1
+    header_format = "<4sIqdIII"
+    alignment = 16
+
+    def __init__(self, source_filename, cache_filename=None):
+        self.source_filename = os.path.abspath(source_filename)
+        self.cache_filename = cache_filename or (source_filename + ".cache")
+        self._log = logging.getLogger('MeshCache')
+
+    def _get_key(self):
+        stat = os.stat(self.source_filename)
+        # byte string paths are used as they are; decoding them to encode
+        # them again fails for non-ASCII names
+        path = self.source_filename
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        return (path, stat.st_size, stat.st_mtime)
+
+    def _get_header_size(self, path):
+        size = struct.calcsize(self.header_format) + len(path)
+        return size + (-size % self.alignment)
+
+    def load(self):
+        """Memory-maps the cached arrays.
+
+        :return: a (vertices, faces) pair or None, if the cache is missing,
+            stale or corrupt
+        """
+        # the messages are byte strings like the paths, so non-ASCII paths
+        # are not decoded
+        if not os.path.exists(self.cache_filename):
+            return None
+        path, size, mtime = self._get_key()
+        try:
+            with open(self.cache_filename, 'rb') as f:
+                header = f.read(struct.calcsize(self.header_format))
+                magic, version, cached_size, cached_mtime, path_length, vertice_count, polygon_count = struct.unpack(self.header_format, header)
+                cached_path = f.read(path_length)
+            if magic != self.magic or version != self.version:
+                raise FileFormatException("unknown cache format")
+            if (cached_path, cached_size, cached_mtime) != (path, size, mtime):
+                self._log.debug("Cache '%s' is stale." % self.cache_filename)
+                return None
+            vertex_offset = self._get_header_size(path)
+            face_offset = vertex_offset + vertice_count * 3 * 8
+            expected_size = face_offset + polygon_count * 3 * 4
+            if os.path.getsize(self.cache_filename) != expected_size:
+                raise FileFormatException("unexpected cache size")
+            vertices = faces = None
+            if vertice_count:
+                vertices = asarray(memmap(self.cache_filename, dtype='<f8', mode='r', offset=vertex_offset, shape=(vertice_count, 3)))
+            if polygon_count:
+                faces = asarray(memmap(self.cache_filename, dtype='<i4', mode='r', offset=face_offset, shape=(polygon_count, 3)))
+            if faces is not None and (faces.min() < 0 or faces.max() >= vertice_count):
+                raise FileFormatException("face indices out of range")
+        except (IOError, struct.error, ValueError, FileFormatException), e:
+            self._log.warning("Ignoring corrupt cache '%s': %s" % (self.cache_filename, e))
+            return None
+        if vertices is None:
+            vertices = zeros((0, 3), dtype='<f8')
+        if faces is None:
+            faces = zeros((0, 3), dtype='<i4')
+        return (vertices, faces)
+
+    def store(self, vertices, faces):
+        """Writes the given arrays to the cache file. The file is written
+        under a temporary name first, so concurrent readers never see a
+        partially written cache.
+        """
+        path, size, mtime = self._get_key()
+        header = struct.pack(self.header_format, self.magic, self.version, size, mtime, len(path), len(vertices), len(faces)) + path
+        header += "\0" * (self._get_header_size(path) - len(header))
+        temp_filename = "%s.%d.tmp" % (self.cache_filename, os.getpid())
+        try:
+            with open(temp_filename, 'wb') as f:
+                f.write(header)
+                f.write(asarray(vertices, dtype='<f8').tostring())
+                f.write(asarray(faces, dtype='<i4').tostring())
+            os.rename(temp_filename, self.cache_filename)
+        except (IOError, OSError), e:
+            self._log.warning("Could not write cache '%s': %s" % (self.cache_filename, e))
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            return False
+        self._log.debug("Wrote cache '%s'." % self.cache_filename)
+        return True
+
+def _parse_range(args):
+    """Parses the whitespace separated values in the byte range [start, end)
+    of a file. This runs in the worker processes of `openOff._parse_parallel`.
+    """
+    filename, start, end = args
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        return fromstring(f.read(end - start), sep=" ")
+
+class MeshReader(object):
+    """Base class of the mesh file readers. Subclasses implement `get_arrays`,
+    the face batches and triangles are derived from it.
+    """
+    batch_size = 16384
+
     def __init__(self, filename):
         self._filename = filename
-        self._log = logging.getLogger('openOff')
-    
+        self._log = logging.getLogger(self.__class__.__name__)
+
+    def get_arrays(self):
+        """Returns the vertex and face data of the mesh.
+
+        :return: a (vertices, faces) pair, where vertices is a (V, 3) float
+            array and faces is a (F, 3) integer array of vertex indices
+        """
+        raise NotImplementedError()
+
+    def iter_faces(self, batch_size=None):
+        """Yields the faces of the mesh in batches.
+
+        :Keywords:
+          batch_size : int
+            the maximum number of faces per batch
+
+        :return: an iterator over (indices, corners) pairs, where indices is
+            a (B, 3) integer array of vertex indices and corners is a
+            (B, 3, 3) float array of the corresponding vertex coordinates
+        """
+        batch_size = batch_size or self.batch_size
+        vertices, faces = self.get_arrays()
+        for start in xrange(0, len(faces), batch_size):
+            indices = faces[start:start+batch_size]
+            yield (indices, vertices[indices])
+
+    def get_mesh(self):
+        """Returns the mesh as an IndexedTriangleMesh, sharing the arrays
+        returned by `get_arrays`.
+        """
+        vertices, faces = self.get_arrays()
+        return IndexedTriangleMesh(vertices, faces)
+
     def get_triangles(self):
-        #f = open(self._filename)
-        with open(self._filename) as f:
-        #try:
-            self._log.debug(u"Opened file '%s' as OFF file." % self._filename)
-            vertices = []
-            triangles = TriangleList()
-            first_line = f.readline()
-            if first_line.startswith("OFF"):
-                vertice_count, polygon_count, edge_count = [ int(value.strip()) for value in f.readline().split(" ") ]
-                for vertex_index in range(vertice_count):
-                    vertices.append(array([ float(coord.strip()) for coord in f.readline().split(" ") if coord.strip() != "" ]))
-                for polygon_index in range(polygon_count):
-                    n, v1, v2, v3 = [ int(value.strip()) for value in f.readline().split(" ") if value.strip() != "" ]
-                    if n != 3:
-                        raise FileFormatException("The file '%s' contains polygons, that are not triangles." % self._filename)
-                    triangles.append(Triangle([vertices[v1], vertices[v2], vertices[v3]]))
-            else:
-                raise FileFormatException("The file '%s' is not of the expected format: %s" % (self._filename, first_line))    
-        #finally:
-        #    f.close()
-                
+        triangles = TriangleList()
+        for indices, corners in self.iter_faces():
+            triangles.extend([Triangle(list(triangle_corners)) for triangle_corners in corners])
+
         self._log.debug(u"Read %d triangles from file '%s'." % (len(triangles), self._filename))
         return triangles
+
+class openOff(MeshReader):
+    parallel_threshold = 32 * 1024 * 1024
+
+    def __init__(self, filename, cache=True, workers=1):
+        """
+        :Parameters:
+          filename : string
+            the OFF file to read
+
+        :Keywords:
+          cache : boolean
+            whether or not to read and write a binary sidecar cache
+          workers : int
+            the number of processes used to parse files larger than
+            `parallel_threshold` bytes (0 means one per cpu, 1 parses serially)
+        """
+        MeshReader.__init__(self, filename)
+        self._cache = cache and MeshCache(filename) or None
+        self._workers = workers or cpu_count()
+
+    def _read_header(self, f):
+        first_line = f.readline()
+        if not first_line.startswith("OFF"):
+            raise FileFormatException("The file '%s' is not of the expected format: %s" % (self._filename, first_line))
+        try:
+            vertice_count, polygon_count, edge_count = [ int(value) for value in f.readline().split() ]
+        except ValueError:
+            raise FileFormatException("The file '%s' has an invalid OFF header." % self._filename)
+        return (vertice_count, polygon_count)
+
+    def get_arrays(self):
+        """Returns the vertex and face data as two contiguous arrays. If
+        caching is enabled, a valid sidecar cache is memory-mapped instead of
+        parsing the file, and a missing or stale one is rebuilt.
+
+        :return: a (vertices, faces) pair, where vertices is a (V, 3) float
+            array and faces is a (F, 3) integer array of vertex indices
+        """
+        if self._cache:
+            arrays = self._cache.load()
+            if arrays:
+                self._log.debug(u"Loaded '%s' from cache." % self._filename)
+                return arrays
+        vertices, faces = self._parse()
+        if self._cache:
+            self._cache.store(vertices, faces)
+        return (vertices, faces)
+
+    def _parse(self):
+        if self._workers > 1 and os.path.getsize(self._filename) >= self.parallel_threshold:
+            vertice_count, polygon_count, values = self._parse_parallel()
+        else:
+            with open(self._filename) as f:
+                self._log.debug(u"Opened file '%s' as OFF file." % self._filename)
+                vertice_count, polygon_count = self._read_header(f)
+                values = fromstring(f.read(), sep=" ")
+        return self._get_arrays_from_values(vertice_count, polygon_count, values)
+
+    def _parse_parallel(self):
+        """Splits the vertex and the face section of the file into byte ranges
+        at line boundaries and parses them in a process pool.
+        
+        :return: a (vertice_count, polygon_count, values) tuple, where values
+            holds all values following the header in file order
+        """
+        with open(self._filename, 'rb') as f:
+            self._log.debug(u"Opened file '%s' as OFF file using %d processes." % (self._filename, self._workers))
+            vertice_count, polygon_count = self._read_header(f)
+            body_start = f.tell()
+            file_size = os.fstat(f.fileno()).st_size
+            if file_size == body_start:
+                line_ends = zeros(0, dtype=int)
+            else:
+                contents = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    line_ends = flatnonzero(frombuffer(contents, dtype=uint8, offset=body_start) == ord("\n")) + body_start + 1
+                    if contents[file_size-1] != "\n":
+                        line_ends = concatenate((line_ends, [file_size]))
+                finally:
+                    contents.close()
+
+        if vertice_count == 0:
+            vertex_end = body_start
+        elif len(line_ends) < vertice_count:
+            raise FileFormatException("The file '%s' ended unexpectedly." % self._filename)
+        else:
+            vertex_end = line_ends[vertice_count-1]
+        ranges = self._split_range(line_ends, body_start, vertex_end) \
+               + self._split_range(line_ends, vertex_end, file_size)
+
+        pool = Pool(self._workers)
+        try:
+            parts = pool.map(_parse_range, [(self._filename, start, end) for start, end in ranges])
+        finally:
+            pool.terminate()
+            pool.join()
+        return (vertice_count, polygon_count, concatenate([zeros(0)] + parts))
+
+    def _split_range(self, line_ends, start, end):
+        """Splits [start, end) into up to one range per worker, cutting only
+        at the given line ends.
+        """
+        if start >= end:
+            return []
+        targets = linspace(start, end, self._workers + 1)[1:-1]
+        cuts = line_ends[clip(searchsorted(line_ends, targets), 0, len(line_ends) - 1)]
+        bounds = unique(concatenate(([start], clip(cuts, start, end), [end]))).astype(int)
+        return zip(bounds[:-1], bounds[1:])
+
+    def _get_arrays_from_values(self, vertice_count, polygon_count, values):
+        vertex_values = 3 * vertice_count
+        if len(values) != vertex_values + 4 * polygon_count:
+            raise FileFormatException("The file '%s' contains polygons, that are not triangles." % self._filename)
+        vertices = values[:vertex_values].reshape((vertice_count, 3))
+        polygons = values[vertex_values:].reshape((polygon_count, 4)).astype(int32)
+        if (polygons[:, 0] != 3).any():
+            raise FileFormatException("The file '%s' contains polygons, that are not triangles." % self._filename)
+        faces = polygons[:, 1:].copy()
+        if len(faces) and (faces.min() < 0 or faces.max() >= vertice_count):
+            raise FileFormatException("The file '%s' references vertices, that do not exist." % self._filename)
+
+        self._log.debug(u"Read %d vertices and %d faces from file '%s'." % (len(vertices), len(faces), self._filename))
+        return (vertices, faces)
+
+    def _iter_blocks(self, f, line_count, values_per_line, batch_size):
+        """Yields the next line_count lines of f as (N, values_per_line)
+        arrays of at most batch_size rows each.
+        """
+        remaining = line_count
+        while remaining > 0:
+            lines = list(islice(f, min(remaining, batch_size)))
+            if not lines:
+                raise FileFormatException("The file '%s' ended unexpectedly." % self._filename)
+            values = fromstring("".join(lines), sep=" ")
+            if len(values) != len(lines) * values_per_line:
+                raise FileFormatException("The file '%s' contains lines with an unexpected number of values." % self._filename)
+            remaining -= len(lines)
+            yield values.reshape((len(lines), values_per_line))
+
+    def iter_faces(self, batch_size=None):
+        """Yields the faces of the mesh in batches while the file is read.
+        Only the vertex array is kept in memory; the faces are never
+        collected. If caching is enabled, the batches are sliced from the
+        memory-mapped cache instead (building it first, if necessary).
+
+        :Keywords:
+          batch_size : int
+            the maximum number of faces per batch
+
+        :return: an iterator over (indices, corners) pairs, where indices is
+            a (B, 3) integer array of vertex indices and corners is a
+            (B, 3, 3) float array of the corresponding vertex coordinates
+        """
+        if self._cache:
+            for batch in MeshReader.iter_faces(self, batch_size):
+                yield batch
+            return
+
+        batch_size = batch_size or self.batch_size
+
+        with open(self._filename) as f:
+            self._log.debug(u"Streaming file '%s' as OFF file." % self._filename)
+            vertice_count, polygon_count = self._read_header(f)
+            vertices = empty((vertice_count, 3))
+            offset = 0
+            for block in self._iter_blocks(f, vertice_count, 3, batch_size):
+                vertices[offset:offset+len(block)] = block
+                offset += len(block)
+            for block in self._iter_blocks(f, polygon_count, 4, batch_size):
+                polygons = block.astype(int32)
+                if (polygons[:, 0] != 3).any():
+                    raise FileFormatException("The file '%s' contains polygons, that are not triangles." % self._filename)
+                indices = polygons[:, 1:].copy()
+                if indices.min() < 0 or indices.max() >= vertice_count:
+                    raise FileFormatException("The file '%s' references vertices, that do not exist." % self._filename)
+                yield (indices, vertices[indices])
+
+class openPly(MeshReader):
+    """Reads triangle meshes from binary little endian PLY files. The file is
+    memory-mapped and the vertex and face arrays are views into the mapping,
+    so loading does not copy or convert the data.
+    """
+    property_types = {
+        'char'      : '<i1', 'int8'     : '<i1',
+        'uchar'     : '<u1', 'uint8'    : '<u1',
+        'short'     : '<i2', 'int16'    : '<i2',
+        'ushort'    : '<u2', 'uint16'   : '<u2',
+        'int'       : '<i4', 'int32'    : '<i4',
+        'uint'      : '<u4', 'uint32'   : '<u4',
+        'float'     : '<f4', 'float32'  : '<f4',
+        'double'    : '<f8', 'float64'  : '<f8',
+        }
+
+    def _get_type(self, name):
+        try:
+            return self.property_types[name]
+        except KeyError:
+            raise FileFormatException("The file '%s' uses the unknown property type '%s'." % (self._filename, name))
+
+    def _read_header(self, f):
+        """Reads the header up to 'end_header'.
+
+        :return: a (elements, data_offset) pair, where elements is a list of
+            (name, count, dtype) tuples in file order
+        """
+        if f.readline().strip() != "ply":
+            raise FileFormatException("The file '%s' is not a PLY file." % self._filename)
+        elements = []
+        for line in iter(f.readline, ""):
+            values = line.split()
+            if not values or values[0] in ("comment", "obj_info"):
+                continue
+            if values[0] == "end_header":
+                return (elements, f.tell())
+            if values[0] == "format":
+                if values[1] != "binary_little_endian":
+                    raise FileFormatException("The file '%s' is in the unsupported PLY format '%s'." % (self._filename, values[1]))
+            elif values[0] == "element":
+                elements.append((values[1], int(values[2]), []))
+            elif values[0] == "property" and elements:
+                if values[1] == "list":
+                    # only fixed size lists of 3 entries (triangles) are supported
+                    elements[-1][2].append((values[4], self._get_type(values[2]), self._get_type(values[3])))
+                else:
+                    elements[-1][2].append((values[2], self._get_type(values[1])))
+            else:
+                raise FileFormatException("The file '%s' has an invalid PLY header: %s" % (self._filename, line))
+        raise FileFormatException("The file '%s' ended unexpectedly." % self._filename)
+
+    def _get_dtype(self, properties):
+        fields = []
+        for field in properties:
+            if len(field) == 3:
+                name, count_type, index_type = field
+                fields.append((name + "_count", count_type))
+                fields.append((name, index_type, (3, )))
+            else:
+                fields.append(field)
+        return dtype(fields)
+
+    def get_arrays(self):
+        with open(self._filename, 'rb') as f:
+            self._log.debug(u"Opened file '%s' as PLY file." % self._filename)
+            elements, offset = self._read_header(f)
+
+        records = {}
+        for name, count, properties in elements:
+            if name in ("vertex", "face"):
+                element_dtype = self._get_dtype(properties)
+                if count:
+                    records[name] = memmap(self._filename, dtype=element_dtype, mode='r', offset=offset, shape=(count, ))
+                else:
+                    records[name] = zeros(0, dtype=element_dtype)
+            elif [property for property in properties if len(property) == 3]:
+                # variable size elements can only be skipped at the end
+                break
+            offset += count * self._get_dtype(properties).itemsize
+        if "vertex" not in records or "face" not in records:
+            raise FileFormatException("The file '%s' does not contain vertex and face elements." % self._filename)
+        if offset > os.path.getsize(self._filename):
+            raise FileFormatException("The file '%s' ended unexpectedly." % self._filename)
+
+        vertex_records = records["vertex"]
+        fields = vertex_records.dtype.fields
+        if not all([coord in fields for coord in "xyz"]):
+            raise FileFormatException("The file '%s' contains vertices without coordinates." % self._filename)
+        coord_type, x_offset = fields["x"][0:2]
+        if fields["y"][0:2] == (coord_type, x_offset + coord_type.itemsize) \
+                and fields["z"][0:2] == (coord_type, x_offset + 2 * coord_type.itemsize):
+            vertices = ndarray((len(vertex_records), 3), dtype=coord_type, buffer=vertex_records, offset=x_offset, strides=(vertex_records.itemsize, coord_type.itemsize))
+        else:
+            vertices = column_stack([vertex_records[coord] for coord in "xyz"])
+
+        face_records = records["face"]
+        for face_field in ("vertex_indices", "vertex_index"):
+            if face_field in face_records.dtype.fields:
+                break
+        else:
+            raise FileFormatException("The file '%s' contains faces without vertex indices." % self._filename)
+        if (face_records[face_field + "_count"] != 3).any():
+            raise FileFormatException("The file '%s' contains polygons, that are not triangles." % self._filename)
+        faces = asarray(face_records[face_field])
+        if len(faces) and (faces.min() < 0 or faces.max() >= len(vertices)):
+            raise FileFormatException("The file '%s' references vertices, that do not exist." % self._filename)
+
+        self._log.debug(u"Read %d vertices and %d faces from file '%s'." % (len(vertices), len(faces), self._filename))
+        return (vertices, faces)
+
+def write_ply(filename, vertices, faces):
+    """Writes a triangle mesh as binary little endian PLY file, which can be
+    memory-mapped by `openPly`.
+    
+    :Parameters:
+      filename : string
+        the file to write
+      vertices : array
+        a (V, 3) array of vertex coordinates
+      faces : array
+        a (F, 3) array of vertex indices
+    """
+    vertices = asarray(vertices, dtype='<f8')
+    face_records = zeros(len(faces), dtype=[('vertex_indices_count', '<u1'), ('vertex_indices', '<i4', (3, ))])
+    face_records['vertex_indices_count'] = 3
+    face_records['vertex_indices'] = faces
+    
+    with open(filename, 'wb') as f:
+        f.write("ply\n")
+        f.write("format binary_little_endian 1.0\n")
+        f.write("element vertex %d\n" % len(vertices))
+        for coord in "xyz":
+            f.write("property double %s\n" % coord)
+        f.write("element face %d\n" % len(face_records))
+        f.write("property list uchar int vertex_indices\n")
+        f.write("end_header\n")
+        f.write(vertices.tostring())
+        f.write(face_records.tostring())
+
+class MeshLoader(Thread):
+    """Loads a mesh on a background thread, so the caller can keep rendering
+    in the meantime. The results are published as attributes: the bounding
+    box as soon as the arrays are read, the indexed mesh, its triangles (as
+    TriangleArray) and the acceleration structure over them when `finished`
+    is set.
+    """
+    def __init__(self, mesh_reader, accelerator_factory=None):
+        """
+        :Parameters:
+          mesh_reader : MeshReader
+            the reader to load the mesh with
+
+        :Keywords:
+          accelerator_factory : callable
+            called with the TriangleArray on the loader thread to build the
+            acceleration structure for the raytracer
+        """
+        Thread.__init__(self, name="MeshLoader")
+        self.daemon = True
+        self._reader = mesh_reader
+        self._accelerator_factory = accelerator_factory
+        self._log = logging.getLogger('MeshLoader')
+        self.finished = Event()
+        self.bounding_box = None
+        self.mesh = None
+        self.triangles = None
+        self.accelerator = None
+        self.error = None
+
+    def run(self):
+        try:
+            mesh = self._reader.get_mesh()
+            self.bounding_box = mesh.get_bounding_box()
+            triangles = mesh.get_triangle_array()
+            if self._accelerator_factory is not None:
+                self.accelerator = self._accelerator_factory(triangles)
+            self.triangles = triangles
+            self.mesh = mesh
+        except Exception, e:
+            self._log.exception(u"Loading the mesh failed.")
+            self.error = e
+        self.finished.set()
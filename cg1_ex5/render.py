@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+This renders a mesh with the raytracer of exercise 5 without opening a window
+or creating an OpenGL context, e.g. for batch renders on headless machines.
+The camera, object pose, material and lights are read from a scene
+description (see render.conf).
+
+The comments in this file are written in the reStructured text format and adhere
+to the commenting style used by epydoc.
+"""
+
+import logging
+import time
+from optparse import OptionParser
+from ConfigParser import SafeConfigParser
+
+import Image
+from numpy import array, cos, dot, eye, outer, radians, sin
+from numpy.linalg import norm
+
+from console import ProgressBar
+from geometry import TriangleArrayInstance
+from raytracer import Light, Material, Raytracer, get_accelerator, look_at, perspective, unproject
+from reader import openOff
+
+def get_vector(config, section, option):
+    return array([float(value) for value in config.get(section, option).split(',')])
+
+def get_rotation(angle, axis):
+    """Returns the matrix set up by glRotate."""
+    x, y, z = array(axis, dtype=float) / norm(axis)
+    c, s = cos(radians(angle)), sin(radians(angle))
+    matrix = eye(4)
+    matrix[0:3, 0:3] = c * eye(3) \
+                     + s * array([[0.0, -z, y], [z, 0.0, -x], [-y, x, 0.0]]) \
+                     + (1 - c) * outer([x, y, z], [x, y, z])
+    return matrix
+
+def get_object_transformation(position, rotation, scaling):
+    """Returns the matrix set up by SceneObject.transform."""
+    translation = eye(4)
+    translation[0:3, 3] = position
+    scale = eye(4)
+    scale[0:3, 0:3] *= scaling
+    transformation = dot(translation, scale)
+    for axis in range(3):
+        transformation = dot(transformation, get_rotation(rotation[axis], eye(3)[axis]))
+    return transformation
+
+def render(config, mesh_filename, workers=1):
+    """Raytraces the mesh as described by the scene description.
+
+    :Parameters:
+      config : SafeConfigParser
+        the scene description
+      mesh_filename : string
+        the OFF file to render
+
+    :return: the rendered image
+    """
+    log = logging.getLogger('render')
+    width = config.getint('camera', 'width')
+    height = config.getint('camera', 'height')
+    stepping = config.getint('render', 'stepping')
+    background = tuple([int(round(value * 255)) for value in get_vector(config, 'render', 'background')])
+
+    modelview = look_at(get_vector(config, 'camera', 'eye'),
+                        get_vector(config, 'camera', 'center'),
+                        get_vector(config, 'camera', 'up'))
+    projection = perspective(config.getfloat('camera', 'fovy'),
+                             float(width) / float(height),
+                             config.getfloat('camera', 'near'),
+                             config.getfloat('camera', 'far'))
+    viewport = (0, 0, width, height)
+    ray_origin = get_vector(config, 'camera', 'eye')
+
+    transformation = get_object_transformation(get_vector(config, 'object', 'position'),
+                                               get_vector(config, 'object', 'rotation'),
+                                               get_vector(config, 'object', 'scaling'))
+    accelerator = get_accelerator(openOff(mesh_filename, workers=workers).get_mesh().get_triangle_array(),
+                                  config.get('render', 'accelerator'))
+    triangles = TriangleArrayInstance(accelerator, transformation)
+    lights = [Light(get_vector(config, section, 'position'),
+                    get_vector(config, section, 'ambient'),
+                    get_vector(config, section, 'diffuse'),
+                    get_vector(config, section, 'specular'))
+              for section in sorted(config.sections()) if section.startswith('light')]
+    material = Material(get_vector(config, 'material', 'ambient'),
+                        get_vector(config, 'material', 'diffuse'),
+                        get_vector(config, 'material', 'specular'))
+    raytracer = Raytracer(triangles, lights, material, config.getint('render', 'max_recursion'))
+
+    log.info(u"Rendering %d triangles at %dx%d..." % (len(triangles), width, height))
+    start = time.time()
+    image = Image.new('RGB', (width, height), background)
+    steps_x = range(0, width, stepping)
+    steps_y = range(0, height, stepping)
+    progress = ProgressBar(0, len(steps_x) * len(steps_y), mode='fixed')
+    progress.output()
+    for window_x in steps_x:
+        # all rays of a column are traced as one packet
+        window_points = array([(window_x, window_y, 0.0) for window_y in steps_y], dtype=float)
+        plane_points = unproject(window_points, modelview, projection, viewport)
+        for window_y, surface_point in zip(steps_y, raytracer.trace_rays(ray_origin, plane_points)):
+            if surface_point:
+                color = tuple([int(round(min(max(value, 0.0), 1.0) * 255)) for value in surface_point[2][0:3]])
+                # window coordinates start at the bottom, image coordinates at the top
+                image_y = height - 1 - window_y
+                image.paste(color, (window_x, max(image_y - stepping + 1, 0), min(window_x + stepping, width), image_y + 1))
+        progress.increment_amount(len(steps_y))
+        progress.output()
+    print
+    log.info(u"Rendered in %.2f s (%s, built in %.2f s)." % (time.time() - start, config.get('render', 'accelerator'),
+                                                             getattr(accelerator, 'build_time', 0.0)))
+    return image
+
+def main():
+    parser = OptionParser(usage=u"%prog [options] [mesh file]")
+    parser.add_option('-s', '--scene', dest='scene_file', default='render.conf', help=u"scene description to use")
+    parser.add_option('-o', '--output', dest='output', default=None, help=u"image file to write (overrides the scene description)")
+    parser.add_option('-a', '--accelerator', dest='accelerator', default=None, help=u"acceleration structure to use: none, bvh or grid (overrides the scene description)")
+    parser.add_option('-w', '--workers', dest='workers', type='int', default=1, help=u"number of processes used to parse large meshes")
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    config = SafeConfigParser()
+    if not config.read([options.scene_file]):
+        parser.error(u"could not read scene description '%s'" % options.scene_file)
+    mesh_filename = args and args[0] or config.get('render', 'mesh')
+    output = options.output or config.get('render', 'output')
+    if options.accelerator:
+        config.set('render', 'accelerator', options.accelerator)
+
+    image = render(config, mesh_filename, options.workers)
+    image.save(output)
+    logging.info(u"Saved image as '%s'." % output)
+
+if __name__ == '__main__':
+    main()
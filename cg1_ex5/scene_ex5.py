@@ -16,10 +16,11 @@ if __name__ == '__main__':
         pass
 
 import sys
+import time
 
 import Image
-from numpy import array, dot, inner, sum
-from numpy.linalg import inv, norm
+from numpy import array, dot, sum
+from numpy.linalg import inv
 from numpy.random import rand
 from OpenGL.arrays import numpymodule
 numpymodule.NumpyHandler.ERROR_ON_COPY = True
@@ -27,9 +28,12 @@ from OpenGL.GL import *
 from OpenGL.GLU import *
 from OpenGL.GLUT import *
 
-from scenegraph import Scene, CuboidNode, TriangleMeshNode, PointerNode, PointCloudNode, ColoredPointCloudNode
-from reader import openOff
+from scenegraph import Scene, CuboidNode, TriangleMeshNode, PointerNode, PointCloudNode, ColoredPointCloudNode, BoundingBoxNode
+from reader import openOff, MeshLoader
 from console import ProgressBar
+from raytracer import Light, Material, Raytracer, get_accelerator, unproject
+from geometry import TriangleArrayInstance
+from bsp import TriangleBspTree
 
 class RaytraceScene(Scene):
     def __init__(self, application):
@@ -118,13 +122,24 @@ class RaytraceScene(Scene):
     def init(self):
         Scene.init(self)
         
-        self.triangles = triangles = openOff("./meshes/icosa.off").get_triangles()
-        self.mesh = TriangleMeshNode(triangles   = triangles,
-                                scene       = self, 
-                                #scaling=[0.5, 0.5, 0.5],
-                                scaling     = [1.0, 1.0, 1.0], 
-                                position    = [0.0, 0.0, 0.0],
-                                draw_origin = False)
+        mesh_reader = openOff("./meshes/icosa.off", workers=self.application._config.getint('reader', 'workers'))
+        self.triangles = None
+        self.accelerator = None
+        self.load_error = None
+        if self.application._config.getboolean('reader', 'background'):
+            # show the bounding box until the mesh has been loaded and the
+            # acceleration structure has been built
+            self._mesh_loader = MeshLoader(mesh_reader, self._create_accelerator)
+            self._mesh_loader.start()
+            self.mesh = BoundingBoxNode(scene       = self, 
+                                        draw_origin = False)
+            self._show_status()
+        else:
+            self._mesh_loader = None
+            mesh = mesh_reader.get_mesh()
+            self.triangles = mesh.get_triangle_array()
+            self.accelerator = self._create_accelerator(self.triangles)
+            self.mesh = self._create_mesh_node(mesh)
         self.pointer = PointerNode(scene       = self, 
                                    draw_origin = False)
         self.points = ColoredPointCloudNode(scene          = self, 
@@ -140,15 +155,108 @@ class RaytraceScene(Scene):
         self.children.append(self.points)
         self.children.append(self.helpers)
     
+    def _create_accelerator(self, triangles):
+        """Builds the acceleration structure configured in the [raytracer]
+        section over the triangles. This runs on the loader thread, when the
+        mesh is loaded in the background.
+        """
+        config = self.application._config
+        accelerator = config.get('raytracer', 'accelerator')
+        if accelerator != 'bsp':
+            return get_accelerator(triangles, accelerator)
+        # the BSP tree of the drawing code answers the ray queries as well
+        bsp_tree = TriangleBspTree(list(triangles), scene=self)
+        progress = ProgressBar(0, len(triangles), mode='fixed')
+        def report_progress(done, total):
+            progress.update_amount(done)
+            progress.output()
+        bsp_tree.autopartition(config.get('bsp', 'plane_selection'),
+                               config.getint('bsp', 'candidate_count'),
+                               config.getfloat('bsp', 'split_weight'),
+                               report_progress)
+        print
+        return bsp_tree
+    
+    def _create_mesh_node(self, mesh):
+        return TriangleMeshNode(triangles   = mesh,
+                                scene       = self, 
+                                #scaling=[0.5, 0.5, 0.5],
+                                scaling     = [1.0, 1.0, 1.0], 
+                                position    = [0.0, 0.0, 0.0],
+                                draw_origin = False)
+    
+    def update(self, d_time):
+        Scene.update(self, d_time)
+        mesh_loader = self._mesh_loader
+        if not mesh_loader:
+            return
+        self.mesh.bounding_box = mesh_loader.bounding_box
+        if mesh_loader.finished.is_set():
+            self._mesh_loader = None
+            placeholder = self.mesh
+            handler = self.application._main_handler
+            if mesh_loader.error:
+                # no mesh will replace the placeholder, so it is removed
+                self.load_error = mesh_loader.error
+                self.mesh = None
+                self.children.remove(placeholder)
+                if handler._selected_node is placeholder:
+                    handler._selected_node = self
+                self._log.error(u"Could not load mesh: %s" % self.load_error)
+                self._show_status()
+                return
+            # swap the placeholder for the mesh, keeping its pose and selection
+            self.mesh = self._create_mesh_node(mesh_loader.mesh)
+            self.mesh.position = placeholder.position
+            self.mesh.rotation = placeholder.rotation
+            self.mesh.offset = placeholder.offset
+            self.mesh.scaling = placeholder.scaling
+            self.mesh.visible = placeholder.visible
+            self.children[self.children.index(placeholder)] = self.mesh
+            if handler._selected_node is placeholder:
+                handler._selected_node = self.mesh
+            self.triangles = mesh_loader.triangles
+            self.accelerator = mesh_loader.accelerator
+            self._log.info(u"Mesh loaded.")
+            self._show_status()
+    
+    def get_status(self):
+        """Returns a short text about loading the mesh or None, once it has
+        been loaded.
+        """
+        if self.load_error is not None:
+            return u"Could not load mesh: %s" % self.load_error
+        if self.triangles is None:
+            return u"The mesh is still being loaded."
+        return None
+    
+    def _show_status(self):
+        """Shows the status after the configured title of the window."""
+        title = self.application._config.get('window', 'title')
+        status = self.get_status()
+        glutSetWindowTitle((status and u"%s - %s" % (title, status) or title).encode('utf-8'))
+    
     def raytrace(self, area=None):
+        if self.triangles is None:
+            self._log.info(self.get_status())
+            return
         self._log.info(u"Starting raytracing...")
         modelview = array(glGetDoublev(GL_MODELVIEW_MATRIX)).transpose()
+        projection = array(glGetDoublev(GL_PROJECTION_MATRIX)).transpose()
+        viewport = glGetIntegerv(GL_VIEWPORT)
         inv_modelview = inv(modelview)
         eye = dot(inv_modelview, array([0.0, 0.0, 0.0, 1.0]))
         
-        transformation = self.mesh.get_transformation()
-        transformed_triangles = self.triangles.transformed(transformation)
-        normal_map = transformed_triangles.get_vertex_normal_map()
+        # the acceleration structure stays in object space, only the rays are transformed
+        transformed_triangles = TriangleArrayInstance(self.accelerator, self.mesh.get_transformation())
+        lights = [Light(glGetLightfv(light, GL_POSITION),
+                        glGetLightfv(light, GL_AMBIENT),
+                        glGetLightfv(light, GL_DIFFUSE),
+                        glGetLightfv(light, GL_SPECULAR)) for light in [GL_LIGHT0, GL_LIGHT1]]
+        material = Material(glGetMaterialfv(GL_FRONT, GL_AMBIENT),
+                            glGetMaterialfv(GL_FRONT, GL_DIFFUSE),
+                            glGetMaterialfv(GL_FRONT, GL_SPECULAR))
+        raytracer = Raytracer(transformed_triangles, lights, material, self.max_recursion)
         
         stepping = self.stepping
         if area:
@@ -165,67 +273,23 @@ class RaytraceScene(Scene):
         self._log.debug(u"Rendering window: %s" % str((window_width, window_height)))
         
         surface_points = []
+        start = time.time()
         progress = ProgressBar(0, len(steps_x) * len(steps_y), mode='fixed')
         progress.output()
         for window_x in steps_x:
-            for window_y in steps_y:
-                plane_point = array(gluUnProject(float(window_x), float(window_y), 0.0))
-                intersection = transformed_triangles.get_closest_intersection(eye[0:3], plane_point, normal_map)
-                if intersection:
-                    intersection_triangle, intersection_point, intersection_normal = intersection
-                    color = self.get_color(intersection_point, eye[0:3], intersection_normal, 0, transformed_triangles, normal_map)
-                    surface_points.append((intersection_point, intersection_normal, color))
-                progress.increment_amount()
-                progress.output()
+            # all rays of a column are traced as one packet
+            window_points = array([(window_x, window_y, 0.0) for window_y in steps_y], dtype=float)
+            plane_points = unproject(window_points, modelview, projection, viewport)
+            for surface_point in raytracer.trace_rays(eye[0:3], plane_points):
+                if surface_point:
+                    surface_points.append(surface_point)
+            progress.increment_amount(len(steps_y))
+            progress.output()
         
         print
+        self._log.info(u"Traced in %.2f s." % (time.time() - start))
         glDisable(GL_LIGHTING)
         self.mesh.visible = False
         self.points.points = surface_points
         self.points.update_display_list()
     
-    def get_color(self, intersection_point, ray_origin, normal, current_recursion, transformed_triangles, normal_map):
-        lights = [GL_LIGHT0, GL_LIGHT1]
-        colors = array([0.0, 0.0, 0.0, 0.0])
-        
-        for light in lights:
-            light_position          = array(glGetLightfv(light, GL_POSITION))[0:3]
-            light_direction         = light_position - intersection_point
-            light_direction         = light_direction / norm(light_direction)
-            
-            if not self.is_in_shadow(intersection_point, light_position, transformed_triangles, normal_map):
-                light_ambient       = array(glGetLightfv(light, GL_AMBIENT))
-                light_diffuse       = array(glGetLightfv(light, GL_DIFFUSE))
-                light_specular      = array(glGetLightfv(light, GL_SPECULAR))
-                material_ambient    = array(glGetMaterialfv(GL_FRONT, GL_AMBIENT))
-                material_diffuse    = array(glGetMaterialfv(GL_FRONT, GL_DIFFUSE))
-                material_specular   = array(glGetMaterialfv(GL_FRONT, GL_SPECULAR))
-            else:
-                light_ambient       = array([0,0,0,1])
-                light_diffuse       = array([0,0,0,1])
-                light_specular      = array([0,0,0,1])
-                material_ambient    = array([0,0,0,1])
-                material_diffuse    = array([0,0,0,1])
-                material_specular   = array([0,0,0,1])
-                
-            incoming_direction = intersection_point - ray_origin
-            outgoing_direction = 2 * (normal * inner(normal, incoming_direction)) - incoming_direction
-            
-            reflective = array([0, 0, 0, 0])
-            while current_recursion + 1 < self.max_recursion:
-                current_recursion += 1
-                new_intersection = transformed_triangles.get_closest_intersection(intersection_point, intersection_point + outgoing_direction, normal_map)
-                if new_intersection != None:
-                    reflective += self.get_color(new_intersection[1], intersection_point, new_intersection[2], current_recursion, transformed_triangles, normal_map)
-            
-            ambient     = light_ambient * material_ambient
-            diffuse     = light_diffuse * material_diffuse * inner(normal, light_direction)
-            specular    = light_specular * material_specular * reflective
-            
-            colors += ambient + diffuse + specular
-        
-        return colors
-        
-    def is_in_shadow(self, intersection_point, light_position, transformed_triangles, normal_map):
-        return transformed_triangles.get_closest_intersection(intersection_point+0.1, light_position, normal_map) != None
-    
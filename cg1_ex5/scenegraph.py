@@ -13,6 +13,8 @@ from numpy.random import rand
 from OpenGL.GL import *
 from OpenGL.GLUT import *
 
+from geometry import IndexedTriangleMesh
+
 class SceneObject(object):
     def __init__(self, name="Object", position=[0, 0, 0], rotation=[0, 0, 0], offset=[0, 0, 0], scaling=[1, 1, 1], size=[1, 1, 1], color=[1, 1, 1, 1], texture=None, draw_origin=False, visible=True):
         self.name           = name
@@ -27,22 +29,30 @@ class SceneObject(object):
         self.visible        = visible
         self.children       = []
         
-        self._dlist_origin = glGenLists(1)
-        glNewList(self._dlist_origin, GL_COMPILE)
-        glPushAttrib(GL_CURRENT_BIT)
-        glBegin(GL_LINES)
-        glColor3f(1, 0, 0)
-        glVertex3f(0, 0, 0)
-        glVertex3f(0.25, 0, 0)
-        glColor3f(0, 1, 0)
-        glVertex3f(0, 0, 0)
-        glVertex3f(0, 0.25, 0)
-        glColor3f(0, 0, 1)
-        glVertex3f(0, 0, 0)
-        glVertex3f(0, 0, 0.25)
-        glEnd()
-        glPopAttrib()
-        glEndList()
+        # the display list of the origin axes is compiled by the first
+        # render, so objects can be created without an OpenGL context, e.g.
+        # on a loader thread
+        self._dlist_origin = None
+    
+    def _get_origin_list(self):
+        if self._dlist_origin is None:
+            self._dlist_origin = glGenLists(1)
+            glNewList(self._dlist_origin, GL_COMPILE)
+            glPushAttrib(GL_CURRENT_BIT)
+            glBegin(GL_LINES)
+            glColor3f(1, 0, 0)
+            glVertex3f(0, 0, 0)
+            glVertex3f(0.25, 0, 0)
+            glColor3f(0, 1, 0)
+            glVertex3f(0, 0, 0)
+            glVertex3f(0, 0.25, 0)
+            glColor3f(0, 0, 1)
+            glVertex3f(0, 0, 0)
+            glVertex3f(0, 0, 0.25)
+            glEnd()
+            glPopAttrib()
+            glEndList()
+        return self._dlist_origin
     
     def transform(self):
         glTranslate(*self.position)
@@ -71,7 +81,7 @@ class SceneObject(object):
                 #glScale(*self.size)
                 glColor4f(1, 1, 1, 0.2)
                 glutWireSphere(0.075, 16, 16)
-                glCallList(self._dlist_origin)
+                glCallList(self._get_origin_list())
                 glPopMatrix()
                 glPopAttrib()
         
@@ -201,6 +211,8 @@ class TriangleMeshNode(Node):
     
     def update_display_list(self):
         logging.debug(u"Updating display lists in window %d" % glutGetWindow())
+        if isinstance(self.node_objects, IndexedTriangleMesh):
+            return self._update_indexed_display_list()
         try:
             normal_map = self.node_objects.get_vertex_normal_map()
             #texture_map = self.node_objects.get_vertex_sphere_map()
@@ -241,10 +253,58 @@ class TriangleMeshNode(Node):
         glPopAttrib()
         glEndList()
     
+    def _update_indexed_display_list(self):
+        mesh = self.node_objects
+        vertices = mesh.vertices
+        normals = mesh.get_vertex_normals()
+        
+        # prepare display list
+        self._dlist_geom = glGenLists(1)
+        glNewList(self._dlist_geom, GL_COMPILE)
+        glPushAttrib(GL_CURRENT_BIT)
+        
+        if self.texture:
+            self.texture()
+        glBegin(GL_TRIANGLES)
+        glColor4fv(tuple(self.color))
+        for vertex_index in mesh.faces.ravel():
+            glNormal3fv(tuple(normals[vertex_index]))
+            glVertex3fv(tuple(vertices[vertex_index]))
+        glEnd()
+        
+        glPopAttrib()
+        glEndList()
+    
     def draw(self):
         Node.draw(self)
         glCallList(self._dlist_geom)
 
+class BoundingBoxNode(Node):
+    """Draws the edges of an axis aligned bounding box, e.g. as placeholder
+    for a mesh, that is still being loaded.
+    """
+    def __init__(self, bounding_box=None, *args, **kwargs):
+        Node.__init__(self, *args, **kwargs)
+        self.bounding_box = bounding_box
+    
+    def draw(self):
+        Node.draw(self)
+        if self.bounding_box is None:
+            return
+        corners = [array([self.bounding_box[(index >> axis) & 1][axis] for axis in range(3)]) for index in range(8)]
+        
+        glPushAttrib(GL_ENABLE_BIT | GL_CURRENT_BIT)
+        glDisable(GL_LIGHTING)
+        glBegin(GL_LINES)
+        glColor4fv(tuple(self.color))
+        for index in range(8):
+            for axis in range(3):
+                if not index & (1 << axis):
+                    glVertex3fv(tuple(corners[index]))
+                    glVertex3fv(tuple(corners[index | (1 << axis)]))
+        glEnd()
+        glPopAttrib()
+
 class PointerNode(Node):
     def __init__(self, *args, **kwargs):
         Node.__init__(self, *args, **kwargs)
@@ -1,19 +1,93 @@
 # -*- coding: utf-8 -*-
 
+import logging
 import time
+from Queue import Queue
+from threading import Thread
 
 import Image
 from OpenGL.GL import *
 from OpenGL.GLU import *
 from OpenGL.GLUT import *
 
-def capture_screen(filename=None):
+class ImageWriter(Thread):
+    """Encodes and saves captured frames on a background thread, so the GLUT
+    callbacks only pay for reading back the pixels. Frames are passed through
+    a bounded queue; when it is full, `put` blocks until the thread caught
+    up, so no frame is ever dropped.
+    """
+    def __init__(self, max_pending=16):
+        """
+        :Keywords:
+          max_pending : int
+            the maximum number of frames waiting to be saved
+        """
+        Thread.__init__(self, name="ImageWriter")
+        self.daemon = True
+        self._queue = Queue(max_pending)
+        self._log = logging.getLogger('ImageWriter')
+    
+    def run(self):
+        while True:
+            frame = self._queue.get()
+            try:
+                if frame is None:
+                    break
+                size, data, filename = frame
+                try:
+                    Image.fromstring('RGB', size, data).save(filename)
+                except IOError, e:
+                    self._log.error(u"Could not save '%s': %s" % (filename, e))
+            finally:
+                self._queue.task_done()
+    
+    def put(self, size, data, filename):
+        self._queue.put((size, data, filename))
+    
+    def flush(self):
+        """Blocks until all queued frames have been saved."""
+        self._queue.join()
+    
+    def close(self):
+        """Saves all queued frames and stops the thread."""
+        if self.is_alive():
+            self._queue.put(None)
+            self.join()
+
+def capture_screen(filename=None, writer=None):
+    """Reads back the current frame buffer and saves it as image.
+    
+    :Keywords:
+      filename : string
+        the file to save to, defaults to a timestamp
+      writer : ImageWriter
+        if given, encoding and saving is left to this writer and no image is
+        returned
+    
+    :return: an (image, filename) pair
+    """
     window_width = glutGet(GLUT_WINDOW_WIDTH)
     window_height = glutGet(GLUT_WINDOW_HEIGHT)
     filename = filename or time.strftime('%Y%m%d_%H%M%S.png')
     
     data = glReadPixels(0, 0, window_width, window_height, GL_RGB, GL_UNSIGNED_BYTE)
+    if writer:
+        writer.put((window_width, window_height), data, filename)
+        return (None, filename)
     image = Image.fromstring('RGB', (window_width, window_height), data)
     image.save(filename)
     
     return (image, filename)
+
+class FrameRecorder(object):
+    """Captures every rendered frame into numbered image files using an
+    ImageWriter.
+    """
+    def __init__(self, writer, prefix=None):
+        self._writer = writer
+        self._prefix = prefix or time.strftime('%Y%m%d_%H%M%S')
+        self.frame_count = 0
+    
+    def capture(self):
+        capture_screen("%s_%06d.png" % (self._prefix, self.frame_count), self._writer)
+        self.frame_count += 1